@@ -0,0 +1,37 @@
+import argparse
+import gc
+import time
+import tracemalloc
+
+from qaeval_expts.metric import QAScoringDatasetReader
+
+
+def measure(input_jsonl: str, compact: bool):
+    gc.collect()
+    tracemalloc.start()
+    start = time.time()
+    instances = QAScoringDatasetReader(compact=compact).read(input_jsonl)
+    elapsed = time.time() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    num_rows = 0
+    for instance in instances:
+        for answered_questions in instance.fields['answered_questions'].answered_questions_list:
+            num_rows += len(answered_questions)
+    return num_rows, current, peak, elapsed
+
+
+def main(args):
+    print(f'{"representation":<16}{"rows":>10}{"retained (MB)":>16}{"peak (MB)":>12}{"bytes/row":>12}{"read (s)":>10}')
+    for name, compact in [('namedtuple', False), ('compact', True)]:
+        num_rows, current, peak, elapsed = measure(args.answers_jsonl, compact)
+        print(f'{name:<16}{num_rows:>10}{current / 1e6:>16.1f}{peak / 1e6:>12.1f}'
+              f'{current / max(num_rows, 1):>12.1f}{elapsed:>10.2f}')
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser()
+    argp.add_argument('answers_jsonl')
+    args = argp.parse_args()
+    main(args)
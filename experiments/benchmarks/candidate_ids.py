@@ -0,0 +1,50 @@
+import argparse
+import random
+import time
+
+from qaeval_expts.generation.generate_candidates import SpanIdGenerator, get_candidate_id
+
+
+def get_spans(text: str, num_spans: int):
+    spans = []
+    for _ in range(num_spans):
+        start = random.randint(0, len(text) - 1)
+        end = random.randint(start + 1, min(len(text), start + 50))
+        spans.append((start, end))
+    return spans
+
+
+def main(args):
+    random.seed(args.seed)
+    words = ['the', 'summary', 'of', 'a', 'document', 'about', 'an', 'earthquake', 'which', 'happened', 'in', 'Turkey']
+    text = ' '.join(random.choice(words) for _ in range(args.num_words))
+    spans = get_spans(text, args.num_spans)
+
+    def run_md5():
+        return [get_candidate_id(text, start, end) for start, end in spans]
+
+    def run_generator(md5_ids: bool):
+        id_generator = SpanIdGenerator(text, md5_ids)
+        return [id_generator.get_id(start, end) for start, end in spans]
+
+    assert run_md5() == run_generator(True)
+
+    print(f'{"scheme":<24}{"ids/s":>14}')
+    for name, run in [('get_candidate_id', run_md5),
+                      ('SpanIdGenerator (md5)', lambda: run_generator(True)),
+                      ('SpanIdGenerator (fast)', lambda: run_generator(False))]:
+        start = time.time()
+        for _ in range(args.num_repeats):
+            run()
+        elapsed = time.time() - start
+        print(f'{name:<24}{args.num_spans * args.num_repeats / elapsed:>14,.0f}')
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--num-words', type=int, default=150)
+    argp.add_argument('--num-spans', type=int, default=100)
+    argp.add_argument('--num-repeats', type=int, default=2000)
+    argp.add_argument('--seed', type=int, default=4)
+    args = argp.parse_args()
+    main(args)
@@ -0,0 +1,74 @@
+import argparse
+import copy
+import spacy
+import time
+from allennlp.predictors import Predictor
+from sacrerouge.io import JsonlReader
+
+from qaeval_expts.generation.coref import TokenizerPredictor, get_rule_based_clusters
+from qaeval_expts.generation.generate_candidates import COREF_MODEL_ARCHIVE, load_nlp, process_instances
+
+
+def run(mode: str, instances, method: str, cuda_device: int):
+    start = time.time()
+    nlp = load_nlp()
+    get_clusters = None
+    if mode == 'spanbert':
+        coref_predictor = Predictor.from_path(COREF_MODEL_ARCHIVE, cuda_device=cuda_device)
+    else:
+        coref_predictor = TokenizerPredictor(spacy.load('en_core_web_sm', disable=['tagger', 'parser', 'ner']).tokenizer)
+        if mode == 'rule':
+            get_clusters = get_rule_based_clusters
+    load_time = time.time() - start
+
+    start = time.time()
+    outputs = list(process_instances(nlp, coref_predictor, copy.deepcopy(instances), method, get_clusters=get_clusters))
+    process_time = time.time() - start
+    return outputs, load_time, process_time
+
+
+def get_alternatives(outputs):
+    # Maps from the candidate ID to the alternative answers from its coreference cluster
+    alternatives = {}
+    for instance in outputs:
+        for candidate in instance['summary']['candidates']:
+            alternatives[candidate['candidate_id']] = candidate['coreference_cluster']
+    return alternatives
+
+
+def main(args):
+    instances = JsonlReader(args.summaries_jsonl).read()[:args.max_instances]
+
+    print(f'{"coref":<10}{"load (s)":>10}{"process (s)":>13}{"summaries/s":>13}{"candidates":>12}'
+          f'{"with alts":>11}{"alts/cand":>11}{"spanbert agr.":>15}')
+    spanbert_alternatives = None
+    for mode in args.modes:
+        outputs, load_time, process_time = run(mode, instances, args.method, args.cuda_device)
+        alternatives = get_alternatives(outputs)
+        num_with_alternatives = sum(len(cluster) > 0 for cluster in alternatives.values())
+        num_alternatives = sum(len(cluster) for cluster in alternatives.values())
+
+        # The fraction of candidates which SpanBERT gives alternative answers to that also have them with this
+        # resolver. The IDs only match if the tokenization is the same, which `TokenizerPredictor` ensures
+        agreement = ''
+        if mode == 'spanbert':
+            spanbert_alternatives = alternatives
+        elif spanbert_alternatives is not None:
+            covered = [candidate_id for candidate_id, cluster in spanbert_alternatives.items() if len(cluster) > 0]
+            num_agree = sum(len(alternatives.get(candidate_id, [])) > 0 for candidate_id in covered)
+            agreement = f'{num_agree / max(len(covered), 1) * 100:.1f}%'
+
+        print(f'{mode:<10}{load_time:>10.1f}{process_time:>13.1f}{len(outputs) / process_time:>13.1f}{len(alternatives):>12}'
+              f'{num_with_alternatives / max(len(alternatives), 1) * 100:>10.1f}%'
+              f'{num_alternatives / max(len(alternatives), 1):>11.2f}{agreement:>15}')
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser()
+    argp.add_argument('summaries_jsonl')
+    argp.add_argument('--method', choices=['all-nps', 'top-nps', 'ner', 'all'], default='all-nps')
+    argp.add_argument('--modes', nargs='+', choices=['spanbert', 'none', 'rule'], default=['spanbert', 'none', 'rule'])
+    argp.add_argument('--max-instances', type=int)
+    argp.add_argument('--cuda-device', type=int, default=-1)
+    args = argp.parse_args()
+    main(args)
@@ -0,0 +1,151 @@
+import argparse
+import time
+import torch
+from allennlp.common.util import import_module_and_submodules
+from allennlp.models.archival import load_archive
+from allennlp.predictors import Predictor
+from sacrerouge.io import JsonlReader
+
+
+class DecodingStats(object):
+    """
+    Records every call to BART's encoder and decoder during the question generation with forward hooks
+    and times the beam search and the BART forward passes it runs. On a GPU, it also counts the number
+    of memory allocations during the beam search.
+    """
+    def __init__(self, model) -> None:
+        self.config = model.bart.config
+        self.encoder_shapes = []
+        self.decoder_calls = []
+        self.search_time = 0.0
+        self.bart_time = 0.0
+        self.num_allocations = 0
+        self._bart_start = None
+        self._handles = [
+            model.bart.model.encoder.register_forward_hook(self._encoder_hook),
+            model.bart.model.decoder.register_forward_hook(self._decoder_hook),
+            model.bart.register_forward_pre_hook(self._bart_pre_hook),
+            model.bart.register_forward_hook(self._bart_hook),
+        ]
+
+        self._beam_search = model._beam_search
+        search = model._beam_search.search
+
+        def timed_search(*args):
+            allocations = self._get_allocations()
+            start = self._get_time()
+            result = search(*args)
+            self.search_time += self._get_time() - start
+            self.num_allocations += self._get_allocations() - allocations
+            return result
+
+        model._beam_search.search = timed_search
+
+    def remove(self) -> None:
+        for handle in self._handles:
+            handle.remove()
+        del self._beam_search.search
+
+    @staticmethod
+    def _get_time() -> float:
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @staticmethod
+    def _get_allocations() -> int:
+        if torch.cuda.is_available():
+            return torch.cuda.memory_stats()['allocation.all.allocated']
+        return 0
+
+    def _bart_pre_hook(self, module, inputs) -> None:
+        self._bart_start = self._get_time()
+
+    def _bart_hook(self, module, inputs, outputs) -> None:
+        self.bart_time += self._get_time() - self._bart_start
+
+    def _encoder_hook(self, module, inputs, outputs) -> None:
+        # shape: (batch_size, source_length, d_model)
+        self.encoder_shapes.append(tuple(outputs[0].size()))
+
+    def _decoder_hook(self, module, inputs, outputs) -> None:
+        # The number of beams which are decoded and the size of the encoder output which the decoder
+        # attends to, which is expanded to the beam size
+        encoder_hidden_states = inputs[1]
+        batch_index = len(self.encoder_shapes) - 1
+        num_bytes = encoder_hidden_states.numel() * encoder_hidden_states.element_size()
+        self.decoder_calls.append((batch_index, encoder_hidden_states.size(0), num_bytes))
+
+    def get_encoder_flops(self, batch_size: int, source_length: int) -> int:
+        # The multiply-adds of the projections, the feed-forward layers and the self-attention
+        d_model, ffn_dim = self.config.d_model, self.config.encoder_ffn_dim
+        per_token = 2 * (4 * d_model * d_model + 2 * d_model * ffn_dim) + 4 * source_length * d_model
+        return self.config.encoder_layers * batch_size * source_length * per_token
+
+    def get_encoder_state_bytes(self) -> int:
+        # Before the encoder output was kept in an `EncoderState`, the beam search gathered it by the backpointers
+        # once for every step of a batch after the first one
+        num_bytes = 0
+        for i, (batch_index, _, size) in enumerate(self.decoder_calls):
+            if i > 0 and self.decoder_calls[i - 1][0] == batch_index:
+                num_bytes += size
+        return num_bytes
+
+
+def run(predictor, inputs, args, by_length: bool) -> None:
+    stats = DecodingStats(predictor._model)
+    start = time.time()
+    if by_length:
+        predictor.predict_batch_json_by_length(inputs, args.max_tokens, args.max_batch_size)
+    else:
+        for i in range(0, len(inputs), args.batch_size):
+            predictor.predict_batch_json(inputs[i:i + args.batch_size])
+    elapsed = time.time() - start
+    stats.remove()
+
+    num_questions = len(inputs)
+    encoder_flops = sum(stats.get_encoder_flops(batch_size, source_length)
+                        for batch_size, source_length, _ in stats.encoder_shapes)
+    num_steps = len(stats.decoder_calls)
+    num_decoded = sum(num_rows for _, num_rows, _ in stats.decoder_calls)
+    if by_length:
+        print(f'batches by length (--max-tokens {args.max_tokens}, --max-batch-size {args.max_batch_size})')
+    else:
+        print(f'fixed batches (--batch-size {args.batch_size})')
+    print(f'questions: {num_questions}, batches: {len(stats.encoder_shapes)}, decoding steps: {num_steps}, '
+          f'questions/s: {num_questions / elapsed:.1f}')
+    print(f'decoded beams per question: {num_decoded / num_questions:.1f}')
+    print(f'encoder GFLOPs per question: {encoder_flops / num_questions / 1e9:.3f}')
+    print(f'encoder GFLOPs per question if it were rerun at every step: '
+          f'{encoder_flops * num_steps / len(stats.encoder_shapes) / num_questions / 1e9:.3f}')
+    print(f'encoder state MB per question which are no longer gathered by the backpointers: '
+          f'{stats.get_encoder_state_bytes() / num_questions / 1e6:.2f}')
+    print(f'ms per step: {stats.search_time / num_steps * 1000:.2f}, '
+          f'ms per step outside of BART: {(stats.search_time - stats.bart_time) / num_steps * 1000:.2f}')
+    if torch.cuda.is_available():
+        print(f'GPU memory allocations per step: {stats.num_allocations / num_steps:.1f}')
+
+
+def main(args):
+    import_module_and_submodules('qaeval_expts.generation.model')
+    archive = load_archive(args.model_tar_gz, cuda_device=args.cuda_device)
+    predictor = Predictor.from_archive(archive, 'question_generation')
+    inputs = JsonlReader(args.input_jsonl).read()[:args.max_instances]
+
+    run(predictor, inputs, args, False)
+    if args.max_tokens is not None:
+        print()
+        run(predictor, inputs, args, True)
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser()
+    argp.add_argument('model_tar_gz')
+    argp.add_argument('input_jsonl')
+    argp.add_argument('--batch-size', type=int, default=16)
+    argp.add_argument('--max-tokens', type=int)
+    argp.add_argument('--max-batch-size', type=int, default=64)
+    argp.add_argument('--max-instances', type=int)
+    argp.add_argument('--cuda-device', type=int, default=-1)
+    args = argp.parse_args()
+    main(args)
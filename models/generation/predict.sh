@@ -4,12 +4,10 @@ output_file=$3
 
 mkdir -p $(dirname ${output_file})
 
-allennlp predict \
-  --include-package qaeval_expts \
-  --output-file ${output_file} \
-  --cuda-device 0 \
-  --predictor question_generation \
-  --silent \
-  --batch-size 16 \
+python -m qaeval_expts.generation.model.predict \
+  ${input_file} \
   ${model_file} \
-  ${input_file}
\ No newline at end of file
+  ${output_file} \
+  --cuda-device 0 \
+  --max-tokens 1024 \
+  --max-batch-size 64
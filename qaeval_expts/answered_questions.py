@@ -0,0 +1,170 @@
+import hashlib
+import numpy as np
+import sys
+from array import array
+from collections import namedtuple
+from collections.abc import Sequence
+from typing import List, Optional
+
+AnsweredQuestion = namedtuple('AnsweredQuestion',
+                              ['prompt_id', 'question_id', 'prediction_id', 'question', 'answer',
+                               'prediction', 'probability', 'null_probability', 'group_id', 'is_correct'])
+
+# The offsets of the groups in a reference's answered questions which are sorted by (prompt_id, question_id).
+# `question_starts` are the row offsets where each question starts and `prompt_starts` are the offsets
+# into the questions where each prompt starts
+GroupIndex = namedtuple('GroupIndex', ['question_starts', 'prompt_starts'])
+
+
+def _intern(text: Optional[str]) -> Optional[str]:
+    return sys.intern(text) if text is not None else None
+
+
+class AnsweredQuestionStore(Sequence):
+    """
+    A compact, column-oriented replacement for a `List[AnsweredQuestion]` (one reference's
+    answered questions). The strings are interned so that the IDs, questions, and answers which are
+    repeated across predictions, peers, and references are only stored once, and the numeric fields
+    are kept in typed arrays instead of one Python object per value. Indexing and iterating
+    return `AnsweredQuestion` tuples, so the store can be used anywhere the list was.
+    """
+    __slots__ = ['prompt_ids', 'question_ids', 'prediction_ids', 'questions', 'answers', 'predictions',
+                 'probabilities', 'null_probabilities', 'group_ids', 'is_correct', 'group_index']
+
+    def __init__(self) -> None:
+        self.prompt_ids = []
+        self.question_ids = []
+        self.prediction_ids = []
+        self.questions = []
+        self.answers = []
+        self.predictions = []
+        self.probabilities = array('d')
+        self.null_probabilities = array('d')
+        self.group_ids = []
+        self.is_correct = array('b')
+        self.group_index = None
+
+    def append(self,
+               prompt_id: str,
+               question_id: str,
+               prediction_id: str,
+               question: str,
+               answer: str,
+               prediction: Optional[str],
+               probability: float,
+               null_probability: float,
+               group_id: Optional[str],
+               is_correct: bool) -> None:
+        self.prompt_ids.append(_intern(prompt_id))
+        self.question_ids.append(_intern(question_id))
+        self.prediction_ids.append(prediction_id)
+        self.questions.append(_intern(question))
+        self.answers.append(_intern(answer))
+        self.predictions.append(_intern(prediction))
+        self.probabilities.append(probability)
+        self.null_probabilities.append(null_probability)
+        self.group_ids.append(_intern(group_id))
+        self.is_correct.append(is_correct)
+
+    def __len__(self) -> int:
+        return len(self.prediction_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return AnsweredQuestion(self.prompt_ids[index], self.question_ids[index], self.prediction_ids[index],
+                                self.questions[index], self.answers[index], self.predictions[index],
+                                self.probabilities[index], self.null_probabilities[index],
+                                self.group_ids[index], bool(self.is_correct[index]))
+
+    def take(self, indices: List[int]) -> 'AnsweredQuestionStore':
+        """Returns a new store with the rows at `indices`."""
+        def _take(column):
+            if isinstance(column, np.ndarray):
+                return column[np.array(indices, dtype=int)]
+            if isinstance(column, array):
+                return array(column.typecode, [column[i] for i in indices])
+            return [column[i] for i in indices]
+
+        store = AnsweredQuestionStore()
+        for name in AnsweredQuestionStore.__slots__:
+            if name != 'group_index':
+                setattr(store, name, _take(getattr(self, name)))
+        return store
+
+    @classmethod
+    def from_list(cls, answered_questions: List[AnsweredQuestion]) -> 'AnsweredQuestionStore':
+        store = cls()
+        for aq in answered_questions:
+            store.append(*aq)
+        return store
+
+
+class AnsweredQuestionList(list):
+    """A list of `AnsweredQuestion`s which has been sorted by `index_answered_questions`."""
+    __slots__ = ['group_index']
+
+
+def _get_column(answered_questions: Sequence, name: str) -> Sequence:
+    if isinstance(answered_questions, AnsweredQuestionStore):
+        return getattr(answered_questions, name + 's')
+    return [getattr(aq, name) for aq in answered_questions]
+
+
+def index_answered_questions(answered_questions: Sequence) -> Sequence:
+    """
+    Sorts one reference's answered questions by (prompt_id, question_id) and attaches the `GroupIndex`
+    of the sorted rows as `group_index`, so the nested averages can be computed without sorting or
+    grouping the rows again. The input is not modified. If it has already been indexed, it is returned as-is.
+    """
+    if getattr(answered_questions, 'group_index', None) is not None:
+        return answered_questions
+
+    prompt_ids = _get_column(answered_questions, 'prompt_id')
+    question_ids = _get_column(answered_questions, 'question_id')
+    # This is a stable sort, so the rows of each question keep their original order
+    order = sorted(range(len(prompt_ids)), key=lambda i: (prompt_ids[i], question_ids[i]))
+
+    question_starts = []
+    prompt_starts = []
+    for position, i in enumerate(order):
+        if position == 0 or question_ids[i] != question_ids[order[position - 1]] or prompt_ids[i] != prompt_ids[order[position - 1]]:
+            if position == 0 or prompt_ids[i] != prompt_ids[order[position - 1]]:
+                prompt_starts.append(len(question_starts))
+            question_starts.append(position)
+
+    if isinstance(answered_questions, AnsweredQuestionStore):
+        indexed = answered_questions.take(order)
+    else:
+        indexed = AnsweredQuestionList(answered_questions[i] for i in order)
+    indexed.group_index = GroupIndex(np.array(question_starts, dtype=int), np.array(prompt_starts, dtype=int))
+    return indexed
+
+
+def get_prediction_ids(answered_questions: Sequence) -> List[str]:
+    if isinstance(answered_questions, AnsweredQuestionStore):
+        return answered_questions.prediction_ids
+    return [aq.prediction_id for aq in answered_questions]
+
+
+def get_content_digest(answered_questions: Sequence) -> str:
+    """
+    Returns an md5 digest of every field of one reference's answered questions which can affect its score
+    (everything except the question text). Unlike the prediction IDs, which only identify the question that
+    was answered, the digest changes if the answers, predictions, probabilities or judgments do.
+    """
+    if isinstance(answered_questions, AnsweredQuestionStore):
+        rows = zip(answered_questions.prompt_ids, answered_questions.question_ids, answered_questions.prediction_ids,
+                   answered_questions.answers, answered_questions.predictions, answered_questions.probabilities,
+                   answered_questions.null_probabilities, answered_questions.group_ids, answered_questions.is_correct)
+    else:
+        rows = ((aq.prompt_id, aq.question_id, aq.prediction_id, aq.answer, aq.prediction, aq.probability,
+                 aq.null_probability, aq.group_id, aq.is_correct) for aq in answered_questions)
+
+    md5 = hashlib.md5()
+    for prompt_id, question_id, prediction_id, answer, prediction, probability, null_probability, group_id, is_correct in rows:
+        # The numbers are converted so the digest is the same for the lists, stores and memory-mapped columns
+        row = (prompt_id, question_id, prediction_id, answer, prediction, float(probability), float(null_probability),
+               group_id, bool(is_correct))
+        md5.update(repr(row).encode())
+    return md5.hexdigest()
@@ -4,6 +4,8 @@ import json
 from sacrerouge.io import JsonlReader, JsonlWriter
 from typing import Any, Dict, Tuple
 
+from qaeval_expts.answers_columns import AnswersColumnsWriter
+
 
 def get_prediction_id(instance_id: str, summarizer_id: str, question_id: str) -> str:
     m = hashlib.md5()
@@ -45,6 +47,9 @@ def load_answers(file_path: str) -> Dict[Tuple[str, str, str], Dict[str, Any]]:
 def main(args):
     answers = load_answers(args.nbest_file)
 
+    # Optionally also write the answers in the columnar format, which is much faster to load for scoring
+    columns_out = AnswersColumnsWriter(args.output_columns) if args.output_columns else None
+
     with JsonlWriter(args.output_jsonl) as out:
         with JsonlReader(args.questions_jsonl) as f:
             for instance in f:
@@ -57,6 +62,11 @@ def main(args):
                         question_dict['predictions'] = [answer]
 
                 out.write(instance)
+                if columns_out is not None:
+                    columns_out.write(instance)
+
+    if columns_out is not None:
+        columns_out.save()
 
 
 if __name__ == '__main__':
@@ -64,5 +74,6 @@ if __name__ == '__main__':
     argp.add_argument('questions_jsonl')
     argp.add_argument('nbest_file')
     argp.add_argument('output_jsonl')
+    argp.add_argument('--output-columns', help='A directory where the answers should also be saved in the columnar format')
     args = argp.parse_args()
     main(args)
\ No newline at end of file
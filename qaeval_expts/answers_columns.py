@@ -0,0 +1,227 @@
+import json
+import numpy as np
+import os
+from array import array
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from qaeval_expts.answered_questions import AnsweredQuestionStore, GroupIndex
+from qaeval_expts.cache import LRUCache
+
+# The answered questions are flattened into one row per prediction. The string columns are indices into
+# a string table which contains every distinct string once. `None` is saved as -1. The rows of each
+# reference are sorted by (prompt_id, question_id) and saved with the offsets of their `GroupIndex`
+STRING_COLUMNS = ['prompt_id', 'question_id', 'prediction_id', 'question', 'answer', 'prediction', 'group_id']
+FLOAT_COLUMNS = ['probability', 'null_probability']
+
+
+def is_answers_columns(path: str) -> bool:
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'string_offsets.npy'))
+
+
+class AnswersColumnsWriter(object):
+    """
+    Writes the answers (the output of `qaeval_expts.answering.postprocess`) as a directory of `.npy`
+    files which `AnswersColumnsReader` can memory-map, so scoring the same answers repeatedly does not
+    require parsing the nested JSON every time. Use it like a `JsonlWriter`.
+    """
+    def __init__(self, output_dir: str) -> None:
+        self.output_dir = output_dir
+        self.strings = []
+        self.string_to_id = {}
+
+        self.instance_columns = {name: array('q') for name in ['instance_id', 'summarizer_id', 'summarizer_type', 'summary', 'reference_start']}
+        self.reference_starts = array('q')
+        self.row_columns = {name: array('q') for name in STRING_COLUMNS}
+        self.row_columns.update({name: array('d') for name in FLOAT_COLUMNS})
+        self.row_columns['is_correct'] = array('b')
+
+        # The `GroupIndex` of every reference, concatenated. The question starts are relative to the reference's
+        # first row and the prompt starts to its first question
+        self.question_starts = array('q')
+        self.prompt_starts = array('q')
+        self.reference_question_starts = array('q')
+        self.reference_prompt_starts = array('q')
+
+    def __enter__(self) -> 'AnswersColumnsWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.save()
+
+    def _get_string_id(self, text: Optional[str]) -> int:
+        if text is None:
+            return -1
+        if text not in self.string_to_id:
+            self.string_to_id[text] = len(self.strings)
+            self.strings.append(text)
+        return self.string_to_id[text]
+
+    def write(self, instance: Dict[str, Any]) -> None:
+        self.instance_columns['instance_id'].append(self._get_string_id(instance['instance_id']))
+        self.instance_columns['summarizer_id'].append(self._get_string_id(instance['summarizer_id']))
+        self.instance_columns['summarizer_type'].append(self._get_string_id(instance['summarizer_type']))
+        # The summary can be a string or a list of sentences, so it is serialized
+        self.instance_columns['summary'].append(self._get_string_id(json.dumps(instance['summary']['text'])))
+        self.instance_columns['reference_start'].append(len(self.reference_starts))
+
+        for reference in instance['references']:
+            self.reference_starts.append(len(self.row_columns['probability']))
+            self.reference_question_starts.append(len(self.question_starts))
+            self.reference_prompt_starts.append(len(self.prompt_starts))
+
+            rows = []
+            for question_dict in reference['questions']:
+                for prediction_dict in question_dict['predictions']:
+                    rows.append((question_dict, prediction_dict))
+            # The same stable sort as `index_answered_questions`, so the rows of each question keep their order
+            rows.sort(key=lambda row: (row[0]['prompt_id'], row[0]['question_id']))
+
+            previous = None
+            num_questions = 0
+            for position, (question_dict, prediction_dict) in enumerate(rows):
+                key = (question_dict['prompt_id'], question_dict['question_id'])
+                if key != previous:
+                    if previous is None or key[0] != previous[0]:
+                        self.prompt_starts.append(num_questions)
+                    self.question_starts.append(position)
+                    num_questions += 1
+                    previous = key
+
+                self.row_columns['prompt_id'].append(self._get_string_id(question_dict['prompt_id']))
+                self.row_columns['question_id'].append(self._get_string_id(question_dict['question_id']))
+                self.row_columns['prediction_id'].append(self._get_string_id(prediction_dict['prediction_id']))
+                self.row_columns['question'].append(self._get_string_id(question_dict['question']))
+                self.row_columns['answer'].append(self._get_string_id(question_dict['answer']))
+                self.row_columns['prediction'].append(self._get_string_id(prediction_dict['answer']))
+                self.row_columns['group_id'].append(self._get_string_id(question_dict.get('group_id')))
+                self.row_columns['probability'].append(prediction_dict['probability'])
+                self.row_columns['null_probability'].append(prediction_dict['null_probability'])
+                self.row_columns['is_correct'].append(prediction_dict.get('is_correct', False))
+
+    def save(self) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        encoded = [text.encode() for text in self.strings]
+        string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(data) for data in encoded], out=string_offsets[1:])
+        np.save(os.path.join(self.output_dir, 'string_data.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        np.save(os.path.join(self.output_dir, 'string_offsets.npy'), string_offsets)
+
+        # The end offsets are added so the reader can slice [start, end) without special cases
+        num_references = len(self.reference_starts)
+        self.instance_columns['reference_start'].append(num_references)
+        self.reference_starts.append(len(self.row_columns['probability']))
+        self.reference_question_starts.append(len(self.question_starts))
+        self.reference_prompt_starts.append(len(self.prompt_starts))
+
+        for name, values in self.instance_columns.items():
+            np.save(os.path.join(self.output_dir, f'instance_{name}.npy'), np.array(values))
+        np.save(os.path.join(self.output_dir, 'reference_start.npy'), np.array(self.reference_starts))
+        np.save(os.path.join(self.output_dir, 'reference_question_start.npy'), np.array(self.reference_question_starts, dtype=np.int64))
+        np.save(os.path.join(self.output_dir, 'reference_prompt_start.npy'), np.array(self.reference_prompt_starts, dtype=np.int64))
+        np.save(os.path.join(self.output_dir, 'question_start.npy'), np.array(self.question_starts, dtype=np.int64))
+        np.save(os.path.join(self.output_dir, 'prompt_start.npy'), np.array(self.prompt_starts, dtype=np.int64))
+        for name, values in self.row_columns.items():
+            np.save(os.path.join(self.output_dir, f'{name}.npy'), np.array(values))
+
+
+class AnswersColumnsReader(object):
+    """
+    Reads the output of `AnswersColumnsWriter`. All of the columns, including the string table, are
+    memory-mapped, and the strings are only decoded when the instance which uses them is read. The IDs and
+    texts which are repeated across predictions, references and peers are decoded once and shared through a
+    small cache. Iterating yields `(instance_id, summarizer_id, summarizer_type, summary, references)` tuples,
+    where `references` has one `AnsweredQuestionStore` per reference. The stores' rows are already sorted and
+    have their `GroupIndex`, and their numeric columns are slices of the memory-mapped files.
+    """
+    def __init__(self, input_dir: str, string_cache_size: int = 10000) -> None:
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(input_dir, f'{name}.npy'), mmap_mode='r')
+
+        self.string_data = load('string_data')
+        self.string_offsets = load('string_offsets')
+        self.string_cache = LRUCache(string_cache_size)
+
+        self.instance_columns = {name: load(f'instance_{name}') for name in ['instance_id', 'summarizer_id', 'summarizer_type', 'summary', 'reference_start']}
+        self.reference_starts = load('reference_start')
+        self.row_columns = {name: load(name) for name in STRING_COLUMNS + FLOAT_COLUMNS + ['is_correct']}
+
+        # Directories which were written before the rows were sorted do not have the group index, so their
+        # rows are sorted when they are scored
+        self.has_group_index = os.path.exists(os.path.join(input_dir, 'question_start.npy'))
+        if self.has_group_index:
+            self.reference_question_starts = load('reference_question_start')
+            self.reference_prompt_starts = load('reference_prompt_start')
+            self.question_starts = load('question_start')
+            self.prompt_starts = load('prompt_start')
+
+    def _decode(self, string_id: int) -> str:
+        return bytes(self.string_data[self.string_offsets[string_id]:self.string_offsets[string_id + 1]]).decode()
+
+    def _get_string(self, string_id: int) -> Optional[str]:
+        if string_id < 0:
+            return None
+        text = self.string_cache.get(string_id)
+        if text is None:
+            text = self._decode(string_id)
+            self.string_cache[string_id] = text
+        return text
+
+    def _get_strings(self, ids: np.ndarray, use_cache: bool = True) -> List[Optional[str]]:
+        if use_cache:
+            return [self._get_string(i) for i in ids.tolist()]
+        return [self._decode(i) if i >= 0 else None for i in ids.tolist()]
+
+    def _get_reference(self, index: int) -> AnsweredQuestionStore:
+        start, end = int(self.reference_starts[index]), int(self.reference_starts[index + 1])
+        store = AnsweredQuestionStore()
+        store.prompt_ids = self._get_strings(self.row_columns['prompt_id'][start:end])
+        store.question_ids = self._get_strings(self.row_columns['question_id'][start:end])
+        # Every prediction ID is unique, so caching them would only evict the strings which are repeated
+        store.prediction_ids = self._get_strings(self.row_columns['prediction_id'][start:end], use_cache=False)
+        store.questions = self._get_strings(self.row_columns['question'][start:end])
+        store.answers = self._get_strings(self.row_columns['answer'][start:end])
+        store.predictions = self._get_strings(self.row_columns['prediction'][start:end])
+        store.group_ids = self._get_strings(self.row_columns['group_id'][start:end])
+        store.probabilities = self.row_columns['probability'][start:end]
+        store.null_probabilities = self.row_columns['null_probability'][start:end]
+        store.is_correct = self.row_columns['is_correct'][start:end]
+        if self.has_group_index:
+            question_start, question_end = self.reference_question_starts[index], self.reference_question_starts[index + 1]
+            prompt_start, prompt_end = self.reference_prompt_starts[index], self.reference_prompt_starts[index + 1]
+            store.group_index = GroupIndex(self.question_starts[question_start:question_end],
+                                           self.prompt_starts[prompt_start:prompt_end])
+        return store
+
+    def __len__(self) -> int:
+        return len(self.instance_columns['instance_id'])
+
+    def iter_keys(self) -> Iterator[Tuple[str, str]]:
+        """
+        Iterates over the `(instance_id, summarizer_id)` of every instance without reading the references.
+        """
+        for i in range(len(self)):
+            yield self._get_string(int(self.instance_columns['instance_id'][i])), \
+                self._get_string(int(self.instance_columns['summarizer_id'][i]))
+
+    def __iter__(self) -> Iterator[Tuple[str, str, str, Any, List[AnsweredQuestionStore]]]:
+        return self.iter_instances()
+
+    def iter_instances(self,
+                       include_instance: Optional[Callable[[str], bool]] = None) \
+            -> Iterator[Tuple[str, str, str, Any, List[AnsweredQuestionStore]]]:
+        """
+        Iterates over the instances. If `include_instance` is given, only the instances whose `instance_id` it
+        returns true for are read, and nothing else is decoded for the others.
+        """
+        reference_start = self.instance_columns['reference_start']
+        for i in range(len(self)):
+            instance_id = self._get_string(int(self.instance_columns['instance_id'][i]))
+            if include_instance is not None and not include_instance(instance_id):
+                continue
+            summarizer_id = self._get_string(int(self.instance_columns['summarizer_id'][i]))
+            summarizer_type = self._get_string(int(self.instance_columns['summarizer_type'][i]))
+            summary = json.loads(self._decode(int(self.instance_columns['summary'][i])))
+
+            references = [self._get_reference(j) for j in range(reference_start[i], reference_start[i + 1])]
+            yield instance_id, summarizer_id, summarizer_type, summary, references
@@ -0,0 +1,86 @@
+import os
+import pickle
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Hashable, IO, Iterator, Optional
+
+
+@contextmanager
+def open_atomic(file_path: str, mode: str = 'w') -> Iterator[IO]:
+    """
+    Opens a temporary file next to `file_path` for writing and moves it to `file_path` once it is
+    closed, so a crash never leaves a truncated file behind. The temporary file's name includes the
+    process ID, so concurrent processes can write the same file.
+    """
+    temp_path = f'{file_path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, mode) as out:
+            yield out
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class HitCounter(object):
+    """
+    Counts the hits and misses of a cache's `get` so the callers can report how effective the cache is.
+    """
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    def get_hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+class LRUCache(HitCounter):
+    """
+    A dictionary-like cache which evicts the least recently used entry once it has more than
+    `max_size` entries (unbounded if `max_size` is `None`).
+    """
+    def __init__(self, max_size: Optional[int] = None) -> None:
+        super().__init__()
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key in self._data:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.max_size is not None:
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def items(self):
+        return self._data.items()
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def save(self, file_path: str) -> None:
+        dirname = os.path.dirname(file_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        with open_atomic(file_path, 'wb') as out:
+            pickle.dump(list(self._data.items()), out)
+
+    def load(self, file_path: str) -> None:
+        with open(file_path, 'rb') as f:
+            for key, value in pickle.load(f):
+                self[key] = value
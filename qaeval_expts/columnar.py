@@ -0,0 +1,113 @@
+import numpy as np
+from typing import List, Sequence
+
+from qaeval_expts.answered_questions import AnsweredQuestion, AnsweredQuestionStore, index_answered_questions
+
+METRIC_NAMES = ['exact-match', 'f1', 'is-answerable', 'human-is-correct']
+
+
+def grouped_mean(values: np.ndarray, group_ids: np.ndarray, num_groups: int) -> np.ndarray:
+    """
+    Averages the rows of `values` (num_rows, num_metrics) which have the same group id. `np.bincount` sums
+    the rows in order, so the result is identical to averaging `MetricsDict`s with `sum(metrics) / len(metrics)`.
+    """
+    counts = np.bincount(group_ids, minlength=num_groups)
+    sums = np.empty((num_groups, values.shape[1]))
+    for j in range(values.shape[1]):
+        sums[:, j] = np.bincount(group_ids, weights=values[:, j], minlength=num_groups)
+    return sums / counts[:, None]
+
+
+class AnsweredQuestionsTable(object):
+    """
+    A columnar representation of the answered questions for a list of references. Every
+    prediction is one row. The rows of each reference are sorted by (prompt_id, question_id), and the
+    offsets of the questions and prompts come from each reference's `GroupIndex`, which is only built
+    once per reference (usually by the dataset reader).
+    """
+    def __init__(self, references: List[Sequence[AnsweredQuestion]]) -> None:
+        self.num_references = len(references)
+
+        question_starts, prompt_starts, prompt_reference_ids = [], [], []
+        prompt_group_ids, group_reference_ids = [], []
+        self.answers, self.predictions = [], []
+        probability, null_probability, is_correct = [], [], []
+        num_rows, num_questions = 0, 0
+        for reference_id, reference in enumerate(references):
+            reference = index_answered_questions(reference)
+            question_starts.append(reference.group_index.question_starts + num_rows)
+            prompt_starts.append(reference.group_index.prompt_starts + num_questions)
+            prompt_reference_ids.append(np.full(len(reference.group_index.prompt_starts), reference_id))
+
+            # All questions of the same prompt should be in the same group (sentence), so the group of
+            # a prompt is the group of its first row. Prompts without a group are their own group
+            first_rows = reference.group_index.question_starts[reference.group_index.prompt_starts]
+            group_to_id = {}
+            for row in first_rows.tolist():
+                group_id = reference.group_ids[row] if isinstance(reference, AnsweredQuestionStore) else reference[row].group_id
+                key = group_id if group_id is not None else ('prompt', row)
+                if key not in group_to_id:
+                    group_to_id[key] = len(group_reference_ids)
+                    group_reference_ids.append(reference_id)
+                prompt_group_ids.append(group_to_id[key])
+
+            num_rows += len(reference)
+            num_questions += len(reference.group_index.question_starts)
+
+            if isinstance(reference, AnsweredQuestionStore):
+                # The store is already columnar, so the columns can be copied directly
+                self.answers.extend(reference.answers)
+                self.predictions.extend(reference.predictions)
+                probability.extend(reference.probabilities)
+                null_probability.extend(reference.null_probabilities)
+                is_correct.extend(reference.is_correct)
+            else:
+                for aq in reference:
+                    self.answers.append(aq.answer)
+                    self.predictions.append(aq.prediction)
+                    probability.append(aq.probability)
+                    null_probability.append(aq.null_probability)
+                    is_correct.append(aq.is_correct)
+
+        self.question_starts = np.concatenate(question_starts + [np.zeros(0, dtype=int)])
+        self.prompt_starts = np.concatenate(prompt_starts + [np.zeros(0, dtype=int)])
+        self.prompt_reference_ids = np.concatenate(prompt_reference_ids + [np.zeros(0, dtype=int)])
+        self.prompt_group_ids = np.array(prompt_group_ids, dtype=int)
+        self.group_reference_ids = np.array(group_reference_ids, dtype=int)
+        self.probability = np.array(probability, dtype=float)
+        self.null_probability = np.array(null_probability, dtype=float)
+        self.is_correct = np.array(is_correct, dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.probability)
+
+    def reference_means(self, values: np.ndarray, include_groups: bool = False) -> np.ndarray:
+        """
+        Computes the per-reference metrics from the per-row `values` (num_rows, num_metrics). The rows are
+        averaged over the predictions for each question, then over the questions for each prompt, then
+        over the prompts for each reference, which is the same order as the original nested loops.
+
+        If `include_groups` is true, the per-prompt means are also averaged over the prompts of each group
+        (the sentence the prompt came from), then over the groups of each reference. Those metrics are
+        returned as `num_metrics` additional columns.
+        """
+        # Average over answers
+        num_questions = len(self.question_starts)
+        question_ids = np.repeat(np.arange(num_questions), np.diff(np.append(self.question_starts, len(self))))
+        question_means = grouped_mean(values, question_ids, num_questions)
+
+        # Average over questions
+        num_prompts = len(self.prompt_starts)
+        prompt_ids = np.repeat(np.arange(num_prompts), np.diff(np.append(self.prompt_starts, num_questions)))
+        prompt_means = grouped_mean(question_means, prompt_ids, num_prompts)
+
+        # Average over prompts
+        reference_means = grouped_mean(prompt_means, self.prompt_reference_ids, self.num_references)
+        if not include_groups:
+            return reference_means
+
+        # Average over the prompts in each group, then over the groups
+        num_groups = len(self.group_reference_ids)
+        group_means = grouped_mean(prompt_means, self.prompt_group_ids, num_groups)
+        group_reference_means = grouped_mean(group_means, self.group_reference_ids, self.num_references)
+        return np.concatenate([reference_means, group_reference_means], axis=1)
@@ -0,0 +1,106 @@
+import json
+import jsons
+import os
+from typing import Any, Dict, Hashable, Tuple
+
+
+class CheckpointedJsonlWriter(object):
+    """
+    Writes the output of a long job to one or more jsonl files (one per name in `output_paths`) in
+    checkpointed chunks, so the job can be resumed if it is interrupted. After every `chunk_size` calls
+    to `write`, the buffered lines are appended to the output files and fsync'd, then the keys of the
+    written items and the sizes of the output files are appended to `progress_path` and fsync'd.
+
+    If `resume` is true, the output files are truncated to their sizes at the last complete checkpoint
+    (which removes anything written after it) and `completed_keys` contains the keys of every item which
+    was written, so the caller can skip them. Otherwise, the output files are overwritten. Use it like a
+    `JsonlWriter`. The items are serialized the same way as `JsonlWriter`, but gzip is not supported.
+    """
+    def __init__(self,
+                 output_paths: Dict[str, str],
+                 progress_path: str,
+                 resume: bool = False,
+                 chunk_size: int = 100) -> None:
+        self.output_paths = output_paths
+        self.progress_path = progress_path
+        self.resume = resume
+        self.chunk_size = chunk_size
+        self.completed_keys = set()
+        self.buffered_keys = []
+        self.buffered_lines = {name: [] for name in output_paths}
+
+    def _load_checkpoint(self) -> Dict[str, int]:
+        offsets = {name: 0 for name in self.output_paths}
+        if not os.path.exists(self.progress_path):
+            return offsets
+
+        valid_length = 0
+        with open(self.progress_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # The job was interrupted while the last checkpoint was being written
+                    break
+                checkpoint = json.loads(line.decode())
+                self.completed_keys.update(tuple(key) for key in checkpoint['keys'])
+                offsets = checkpoint['offsets']
+                valid_length += len(line)
+
+        if set(offsets.keys()) != set(self.output_paths.keys()):
+            raise Exception(f'Cannot resume because the outputs {sorted(offsets.keys())} do not match '
+                            f'{sorted(self.output_paths.keys())}')
+
+        # Remove the incomplete checkpoint so the new ones are appended after the last complete one
+        os.truncate(self.progress_path, valid_length)
+        return offsets
+
+    def __enter__(self) -> 'CheckpointedJsonlWriter':
+        for path in list(self.output_paths.values()) + [self.progress_path]:
+            if path.endswith('.gz') or path.endswith('.bz2'):
+                raise Exception(f'Compressed output files cannot be checkpointed: {path}')
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+
+        offsets = self._load_checkpoint() if self.resume else {name: 0 for name in self.output_paths}
+        self.files = {}
+        for name, path in self.output_paths.items():
+            if os.path.exists(path):
+                os.truncate(path, offsets[name])
+            elif offsets[name] > 0:
+                raise Exception(f'Cannot resume because the output file is missing: {path}')
+            self.files[name] = open(path, 'ab')
+        self.progress_file = open(self.progress_path, 'a' if self.resume else 'w')
+        return self
+
+    def write(self, key: Tuple[Hashable, ...], name_to_item: Dict[str, Any]) -> None:
+        self.buffered_keys.append(list(key))
+        for name, item in name_to_item.items():
+            self.buffered_lines[name].append(jsons.dumps(item).encode() + b'\n')
+        if len(self.buffered_keys) >= self.chunk_size:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        if len(self.buffered_keys) == 0:
+            return
+
+        # The output is made durable before the checkpoint which refers to it
+        offsets = {}
+        for name, f in self.files.items():
+            f.write(b''.join(self.buffered_lines[name]))
+            f.flush()
+            os.fsync(f.fileno())
+            offsets[name] = f.tell()
+            self.buffered_lines[name] = []
+
+        self.progress_file.write(json.dumps({'keys': self.buffered_keys, 'offsets': offsets}) + '\n')
+        self.progress_file.flush()
+        os.fsync(self.progress_file.fileno())
+        self.completed_keys.update(tuple(key) for key in self.buffered_keys)
+        self.buffered_keys = []
+
+    def __exit__(self, *args) -> None:
+        # Everything in the buffer was completely processed, so it is saved even if there was an exception
+        self.checkpoint()
+        for f in self.files.values():
+            f.close()
+        self.progress_file.close()
@@ -0,0 +1,89 @@
+from spacy.tokens import Doc
+from typing import Any, Dict, List, Tuple
+
+# The entity types which are resolved by `get_rule_based_clusters` (the same ones as the "ner" prompts)
+ENTITY_LABELS = {'PERSON', 'NORP', 'FAC', 'ORG', 'GPE', 'LOC', 'EVENT', 'WORK_OF_ART'}
+PERSON_PRONOUNS = {'he', 'him', 'his', 'she', 'her', 'hers'}
+NON_PERSON_PRONOUNS = {'it', 'its', 'they', 'them', 'their', 'theirs'}
+
+
+class TokenizerPredictor(object):
+    """
+    A replacement for the AllenNLP coreference predictor which only tokenizes the summaries with spaCy's
+    tokenizer (which is what the coreference predictor uses) and does not find any clusters. It has the
+    same `predict` and `predict_batch_json` methods, so it can be used anywhere the predictor is. Like the
+    coreference predictor, it keeps the whitespace tokens (e.g., from double spaces or newlines) and
+    normalizes the words, so the `document` tokens and the candidate IDs are the same with both.
+    """
+    def __init__(self, tokenizer) -> None:
+        self.tokenizer = tokenizer
+
+    @staticmethod
+    def _normalize_word(word: str) -> str:
+        # The same as `CorefPredictor._normalize_word`
+        if word in ('/.', '/?'):
+            return word[1:]
+        return word
+
+    def predict(self, document: str) -> Dict[str, Any]:
+        tokens = [self._normalize_word(token.text) for token in self.tokenizer(document)]
+        return {'document': tokens, 'clusters': []}
+
+    def predict_batch_json(self, inputs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [self.predict(inputs_dict['document']) for inputs_dict in inputs]
+
+
+def get_rule_based_clusters(doc: Doc) -> List[List[Tuple[int, int]]]:
+    """
+    A cheap coreference resolver which only uses the spaCy parse. Named entities with the same text
+    (ignoring case and a leading "the") are put in the same cluster, and so is a one-word person name
+    which is the first or last word of an earlier person (e.g., "Obama" and "Barack Obama"). Then every
+    third-person pronoun is added to the cluster of the closest preceding entity, where "he" and "she"
+    refer to people and "it" and "they" to everything else. The clusters use the same format as the
+    coreference predictor (inclusive token offsets) and only contain clusters with more than one mention.
+    """
+    clusters = []
+    key_to_cluster = {}
+    name_to_cluster = {}
+    end_to_cluster = {}
+    in_entity = set()
+    for entity in doc.ents:
+        if entity.label_ not in ENTITY_LABELS:
+            continue
+        words = [token.lower_ for token in entity]
+        if len(words) > 1 and words[0] == 'the':
+            words = words[1:]
+        key = ' '.join(words)
+        is_person = entity.label_ == 'PERSON'
+
+        if key in key_to_cluster:
+            cluster_index = key_to_cluster[key]
+        elif is_person and len(words) == 1 and key in name_to_cluster:
+            cluster_index = name_to_cluster[key]
+        else:
+            cluster_index = len(clusters)
+            clusters.append([])
+            key_to_cluster[key] = cluster_index
+        if is_person and len(words) > 1:
+            name_to_cluster.setdefault(words[0], cluster_index)
+            name_to_cluster.setdefault(words[-1], cluster_index)
+
+        clusters[cluster_index].append((entity.start, entity.end - 1))
+        end_to_cluster[entity.end - 1] = (cluster_index, is_person)
+        in_entity.update(range(entity.start, entity.end))
+
+    last_person_cluster, last_non_person_cluster = None, None
+    for token in doc:
+        if token.i in end_to_cluster:
+            cluster_index, is_person = end_to_cluster[token.i]
+            if is_person:
+                last_person_cluster = cluster_index
+            else:
+                last_non_person_cluster = cluster_index
+        elif token.i not in in_entity:
+            if token.lower_ in PERSON_PRONOUNS and last_person_cluster is not None:
+                clusters[last_person_cluster].append((token.i, token.i))
+            elif token.lower_ in NON_PERSON_PRONOUNS and last_non_person_cluster is not None:
+                clusters[last_non_person_cluster].append((token.i, token.i))
+
+    return [sorted([start, end] for start, end in cluster) for cluster in clusters if len(cluster) > 1]
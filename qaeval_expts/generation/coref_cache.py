@@ -0,0 +1,43 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional
+
+from qaeval_expts.cache import HitCounter, open_atomic
+
+
+class CorefCache(HitCounter):
+    """
+    A persistent cache of the coreference model's output (the `document` tokens and the `clusters`). Each
+    result is saved as its own JSON file under `cache_dir` and is addressed by the hash of the model archive
+    and the summary text, so the cache can be shared by every experiment (and by concurrent runs) and an
+    entry is never used for a different summary or model.
+    """
+    def __init__(self, cache_dir: str, model_archive: str) -> None:
+        super().__init__()
+        self.cache_dir = cache_dir
+        self.model_archive = model_archive
+
+    def _get_path(self, text: str) -> str:
+        m = hashlib.md5()
+        m.update(self.model_archive.encode())
+        m.update(b'\0')
+        m.update(text.encode())
+        key = m.hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def get(self, text: str) -> Optional[Dict[str, Any]]:
+        path = self._get_path(text)
+        if os.path.exists(path):
+            self.hits += 1
+            with open(path, 'r') as f:
+                return json.load(f)
+        self.misses += 1
+        return None
+
+    def __setitem__(self, text: str, coref_result: Dict[str, Any]) -> None:
+        path = self._get_path(text)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open_atomic(path) as out:
+            json.dump({'document': coref_result['document'], 'clusters': coref_result['clusters']}, out)
@@ -1,12 +1,21 @@
 import allennlp_models.coref
 import argparse
 import hashlib
+import multiprocessing
 import spacy
+import threading
+import time
+import traceback
+from contextlib import ExitStack
 from allennlp.predictors import Predictor
 from sacrerouge.io import JsonlReader, JsonlWriter
-from spacy.tokens import Span
+from spacy.tokens import Doc, Span
 from tqdm import tqdm
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from qaeval_expts.generation.checkpoint import CheckpointedJsonlWriter
+from qaeval_expts.generation.coref import TokenizerPredictor, get_rule_based_clusters
+from qaeval_expts.generation.coref_cache import CorefCache
 
 
 PRONOUNS = {
@@ -19,28 +28,59 @@ PRONOUNS = {
     'their', 'theirs'
 }
 
+COREF_MODEL_ARCHIVE = 'https://storage.googleapis.com/allennlp-public-models/coref-spanbert-large-2020.02.27.tar.gz'
+
 
 class EmptySummaryException(Exception):
     pass
 
 
-def get_prompts_all(sentence: Span) -> List[Span]:
-    all_prompts = []
-    all_prompts.extend(get_prompts_all_nps(sentence))
-    all_prompts.extend(get_prompts_top_nps(sentence))
-    all_prompts.extend(get_prompts_ner(sentence))
+METHODS = ['all-nps', 'top-nps', 'ner', 'all']
+
 
+def merge_prompts(*prompts_lists: List[Span]) -> List[Span]:
     offsets_to_prompt = {}
-    for prompt in all_prompts:
-        offsets_to_prompt[(prompt.start_char, prompt.end_char)] = prompt
+    for prompts in prompts_lists:
+        for prompt in prompts:
+            offsets_to_prompt[(prompt.start_char, prompt.end_char)] = prompt
     return list(offsets_to_prompt.values())
 
 
+def get_prompts_all(sentence: Span) -> List[Span]:
+    return merge_prompts(get_prompts_all_nps(sentence), get_prompts_top_nps(sentence), get_prompts_ner(sentence))
+
+
 def get_prompts_all_nps(sentence: Span) -> List[Span]:
     return list(sentence.noun_chunks)
 
 
+def get_subtree_spans(sentence: Span) -> Dict[int, Tuple[int, int]]:
+    """
+    Computes the minimum and maximum token index of every token's subtree with one
+    pass over the sentence. The result maps from the token's index to (min, max).
+    """
+    # A pre-order traversal from the root, so every token comes after its head
+    nodes = []
+    stack = [sentence.root]
+    while len(stack) > 0:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.children)
+
+    # Going backwards, every token's subtree is complete before it is merged into its head's
+    spans = {node.i: (node.i, node.i) for node in nodes}
+    for node in reversed(nodes):
+        if node.head.i != node.i and node.head.i in spans:
+            min_index, max_index = spans[node.i]
+            head_min_index, head_max_index = spans[node.head.i]
+            spans[node.head.i] = (min(head_min_index, min_index), max(head_max_index, max_index))
+    return spans
+
+
 def get_prompts_top_nps(sentence: Span) -> List[Span]:
+    subtree_spans = get_subtree_spans(sentence)
+    sent_start_index = sentence[0].i
+
     root = sentence.root
     nodes = [root]
     nps = []
@@ -52,17 +92,7 @@ def get_prompts_top_nps(sentence: Span) -> List[Span]:
         # which are descendants of this node
         recurse = True
         if node.pos_ in ['NOUN', 'PROPN']:
-            min_index = node.i
-            max_index = node.i
-            stack = [node]
-            while len(stack) > 0:
-                current = stack.pop()
-                min_index = min(min_index, current.i)
-                max_index = max(max_index, current.i)
-                for child in current.children:
-                    stack.append(child)
-
-            sent_start_index = sentence[0].i
+            min_index, max_index = subtree_spans[node.i]
 
             # Because of parsing issues, we only take NPs if they are shorter than a given length
             num_tokens = max_index - min_index + 1
@@ -101,6 +131,53 @@ def get_prompts(method: str, sentence: Span) -> List[Span]:
         raise Exception(f'Unknown method: {method}')
 
 
+def get_prompts_for_methods(methods: List[str], sentence: Span) -> Dict[str, List[Span]]:
+    # Each method runs at most once, and the "all" prompts are merged from the other methods' prompts
+    # the same way `get_prompts_all` does
+    method_to_prompts = {}
+    for method in ['all-nps', 'top-nps', 'ner']:
+        if method in methods or 'all' in methods:
+            method_to_prompts[method] = get_prompts(method, sentence)
+    if 'all' in methods:
+        method_to_prompts['all'] = merge_prompts(method_to_prompts['all-nps'],
+                                                 method_to_prompts['top-nps'],
+                                                 method_to_prompts['ner'])
+    return {method: method_to_prompts[method] for method in methods}
+
+
+class ClusterIndex(object):
+    """
+    An index of a document's coreference clusters which finds the cluster of a token span without
+    scanning every mention. For every token, it stores the end of each mention which contains the token
+    (in the order of the clusters), and the non-pronoun phrases of every cluster are only computed once.
+    """
+    def __init__(self, clusters: List[List[Tuple[int, int]]], tokens: List[str]) -> None:
+        self.token_to_mentions = [[] for _ in tokens]
+        self.cluster_phrases = []
+        for cluster_index, cluster in enumerate(clusters):
+            cluster_phrases = set()
+            for i, j in cluster:
+                for k in range(i, j + 1):
+                    self.token_to_mentions[k].append((j, cluster_index))
+                phrase = ' '.join(tokens[i:j + 1])
+                if phrase.lower() not in PRONOUNS:
+                    cluster_phrases.add(phrase)
+            self.cluster_phrases.append(list(sorted(cluster_phrases)))
+
+    def find_cluster(self, start: int, end: int) -> List[str]:
+        """
+        Find the coreference cluster that corresponds to the phrase that corresponds
+        to the token span [start, end). It will return the first cluster that contains
+        a phrase that subsumes the tokens.
+        """
+        # Every mention in the list starts at or before `start` and ends at or after `start`,
+        # so it subsumes the NP if it also ends at or after `end - 1`
+        for j, cluster_index in self.token_to_mentions[start]:
+            if end - 1 <= j:
+                return list(self.cluster_phrases[cluster_index])
+        return []
+
+
 def find_cluster(clusters: List[List[Tuple[int, int]]],
                  tokens: List[str],
                  start: int,
@@ -108,25 +185,10 @@ def find_cluster(clusters: List[List[Tuple[int, int]]],
     """
     Find the coreference cluster that corresponds to the phrase that corresponds
     to the token span (start, end]. It will return the first cluster that contains
-    a phrase that subsumes the tokens.
-    """
-    for cluster in clusters:
-        is_in_cluster = False
-        for i, j in cluster:
-            # [i, j] is inclusive, [start, end) is exclusive
-            if i <= start <= j and i <= (end - 1) <= j:
-                # This cluster span subsumes the NP, so we say
-                # it belongs to this cluster
-                is_in_cluster = True
-
-        if is_in_cluster:
-            cluster_phrases = set()
-            for i, j in cluster:
-                phrase = ' '.join(tokens[i:j + 1])
-                if phrase.lower() not in PRONOUNS:
-                    cluster_phrases.add(phrase)
-            return list(sorted(cluster_phrases))
-    return []
+    a phrase that subsumes the tokens. To look up many spans in the same document,
+    build a `ClusterIndex` once instead.
+    """
+    return ClusterIndex(clusters, tokens).find_cluster(start, end)
 
 
 def get_candidate_id(text: str, start: int, end: int) -> str:
@@ -141,64 +203,445 @@ def get_group_id(text: str, start: int, end: int) -> str:
     return get_candidate_id(text, start, end)
 
 
-def process_instance(nlp, coref_predictor, instance: Dict[str, Any], method: str):
+class SpanIdGenerator(object):
+    """
+    Generates the IDs of the candidates and sentences (groups) of one summary while only hashing the text
+    once. If `md5_ids` is true, the IDs are identical to `get_candidate_id` because they are computed from a
+    copy of the text's md5 state. Otherwise, the ID is the text's digest followed by the offsets in hex,
+    which does not hash anything per span (and cannot collide like "1" + "23" and "12" + "3").
+    """
+    def __init__(self, text: str, md5_ids: bool = True) -> None:
+        self.md5_ids = md5_ids
+        self.text_md5 = hashlib.md5(text.encode())
+        self.text_digest = self.text_md5.hexdigest()
+
+    def get_id(self, start: int, end: int) -> str:
+        if self.md5_ids:
+            m = self.text_md5.copy()
+            m.update(str(start).encode())
+            m.update(str(end).encode())
+            return m.hexdigest()
+        return f'{self.text_digest}-{start:x}-{end:x}'
+
+
+def get_summary_text(instance: Dict[str, Any]) -> str:
     original_summary = instance['summary']['text']
     if isinstance(original_summary, list):
         original_summary = ' '.join(original_summary)
     if len(original_summary.strip()) == 0:
         raise EmptySummaryException()
+    return original_summary
+
 
-    coref_result = coref_predictor.predict(document=original_summary)
+def preprocess_instance(coref_predictor, instance: Dict[str, Any]) -> Tuple[List[str], List[List[Tuple[int, int]]]]:
+    coref_result = coref_predictor.predict(document=get_summary_text(instance))
     tokens = coref_result['document']
     clusters = coref_result['clusters']
+    return tokens, clusters
 
+
+def preprocess_instances(coref_predictor,
+                         instances: Iterable[Dict[str, Any]],
+                         batch_size: int = 8,
+                         num_batches_per_window: int = 16,
+                         coref_cache: Optional[CorefCache] = None) -> Iterator[Tuple[Dict[str, Any], List[str], List[List[Tuple[int, int]]]]]:
+    """
+    Runs `preprocess_instance` on a stream of instances, but the coreference model is run on batches
+    of `batch_size` summaries with `predict_batch_json`. To minimize the padding, each window of
+    `batch_size * num_batches_per_window` summaries is sorted by length before it is split into
+    batches. The results are yielded in the same order as the input. Empty summaries are skipped.
+
+    If `coref_cache` is not `None`, only the summaries which are not in the cache are run through
+    the model, and their results are added to the cache.
+    """
+    def predict_window(window: List[Tuple[Dict[str, Any], str]]):
+        coref_results = [None] * len(window)
+        if coref_cache is not None:
+            coref_results = [coref_cache.get(text) for _, text in window]
+
+        # Identical summaries (e.g., the same reference in several instances) are only run once
+        text_to_indices = {}
+        for index, coref_result in enumerate(coref_results):
+            if coref_result is None:
+                text_to_indices.setdefault(window[index][1], []).append(index)
+
+        texts = sorted(text_to_indices.keys(), key=lambda text: len(text.split()))
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            outputs = coref_predictor.predict_batch_json([{'document': text} for text in batch])
+            for text, output in zip(batch, outputs):
+                for index in text_to_indices[text]:
+                    coref_results[index] = output
+                if coref_cache is not None:
+                    coref_cache[text] = output
+
+        for (instance, _), coref_result in zip(window, coref_results):
+            yield instance, coref_result['document'], coref_result['clusters']
+
+    window = []
+    for instance in instances:
+        try:
+            window.append((instance, get_summary_text(instance)))
+        except EmptySummaryException:
+            continue
+        if len(window) == batch_size * num_batches_per_window:
+            yield from predict_window(window)
+            window = []
+    if len(window) > 0:
+        yield from predict_window(window)
+
+
+def get_candidates(doc: Doc,
+                   tokens: List[str],
+                   clusters: List[List[Tuple[int, int]]],
+                   methods: List[str],
+                   md5_ids: bool = True) -> Dict[str, List[Dict[str, Any]]]:
     text = ' '.join(tokens)
-    doc = nlp(tokens)
     assert len(doc) == len(tokens)
 
+    id_generator = SpanIdGenerator(text, md5_ids)
+    cluster_index = ClusterIndex(clusters, tokens)
+    method_to_candidates = {method: [] for method in methods}
+    for sent in doc.sents:
+        group_id = id_generator.get_id(sent.start_char, sent.end_char)
+
+        # The same NP is usually extracted by several methods, so the candidates are shared
+        offsets_to_candidate = {}
+        for method, nps in get_prompts_for_methods(methods, sent).items():
+            for np in nps:
+                offsets = (np.start_char, np.end_char)
+                if offsets not in offsets_to_candidate:
+                    np_cluster = cluster_index.find_cluster(np.start, np.end)
+                    candidate_id = id_generator.get_id(np.start_char, np.end_char)
+                    offsets_to_candidate[offsets] = {
+                        'candidate_id': candidate_id,
+                        'group_id': group_id,
+                        'candidate': str(np),
+                        'candidate_start': np.start_char,
+                        'candidate_end': np.end_char,
+                        'sent_start': sent.start_char,
+                        'sent_end': sent.end_char,
+                        'coreference_cluster': np_cluster
+                    }
+                method_to_candidates[method].append(offsets_to_candidate[offsets])
+    return method_to_candidates
+
+
+def add_candidates(doc: Doc,
+                   tokens: List[str],
+                   clusters: List[List[Tuple[int, int]]],
+                   instance: Dict[str, Any],
+                   method: str) -> None:
     # Replace the summary's text with the preprocessed version
-    instance['summary']['text'] = text
+    instance['summary']['text'] = ' '.join(tokens)
+    instance['summary']['candidates'] = get_candidates(doc, tokens, clusters, [method])[method]
 
-    candidates = []
-    for sent in doc.sents:
-        group_id = get_group_id(text, sent.start_char, sent.end_char)
-        for np in get_prompts(method, sent):
-            np_cluster = find_cluster(clusters, tokens, np.start, np.end)
-            candidate_id = get_candidate_id(text, np.start_char, np.end_char)
-            candidates.append({
-                'candidate_id': candidate_id,
-                'group_id': group_id,
-                'candidate': str(np),
-                'candidate_start': np.start_char,
-                'candidate_end': np.end_char,
-                'sent_start': sent.start_char,
-                'sent_end': sent.end_char,
-                'coreference_cluster': np_cluster
-            })
-    instance['summary']['candidates'] = candidates
 
+def process_instance(nlp,
+                     coref_predictor,
+                     instance: Dict[str, Any],
+                     method: str,
+                     get_clusters: Optional[Callable[[Doc], List[List[Tuple[int, int]]]]] = None):
+    tokens, clusters = preprocess_instance(coref_predictor, instance)
+    doc = nlp(tokens)
+    if get_clusters is not None:
+        clusters = get_clusters(doc)
+    add_candidates(doc, tokens, clusters, instance, method)
 
-def main(args):
+
+def get_method_to_instance(doc: Doc,
+                           instance: Dict[str, Any],
+                           tokens: List[str],
+                           clusters: List[List[Tuple[int, int]]],
+                           methods: List[str],
+                           get_clusters: Optional[Callable[[Doc], List[List[Tuple[int, int]]]]] = None,
+                           md5_ids: bool = True) -> Dict[str, Dict[str, Any]]:
+    if get_clusters is not None:
+        clusters = get_clusters(doc)
+
+    # Replace the summary's text with the preprocessed version
+    instance['summary']['text'] = ' '.join(tokens)
+    method_to_instance = {}
+    for method, candidates in get_candidates(doc, tokens, clusters, methods, md5_ids).items():
+        method_to_instance[method] = dict(instance, summary=dict(instance['summary'], candidates=candidates))
+    return method_to_instance
+
+
+def process_instances_multi(nlp,
+                            coref_predictor,
+                            instances: Iterable[Dict[str, Any]],
+                            methods: List[str],
+                            batch_size: int = 32,
+                            n_process: int = 1,
+                            coref_batch_size: int = 8,
+                            coref_cache: Optional[CorefCache] = None,
+                            get_clusters: Optional[Callable[[Doc], List[List[Tuple[int, int]]]]] = None,
+                            md5_ids: bool = True) -> Iterator[Dict[str, Dict[str, Any]]]:
+    """
+    Runs `process_instance` on a stream of instances for several methods at once, so the coreference
+    and the spaCy parse are only computed once per summary. The coreference model and spaCy are run
+    in batches (see `preprocess_instances`) and with `nlp.pipe` (optionally in `n_process` processes).
+    For each instance, a dictionary from the method to a copy of the instance with that method's
+    candidates is yielded in the same order as the input. Empty summaries are skipped.
+
+    If `get_clusters` is not `None`, it computes the coreference clusters from the spaCy parse
+    instead of using the clusters from `coref_predictor`. If `md5_ids` is false, the candidate and
+    group IDs are generated without md5 (see `SpanIdGenerator`).
+    """
+    preprocessed = ((tokens, (instance, tokens, clusters))
+                    for instance, tokens, clusters in preprocess_instances(coref_predictor, instances, coref_batch_size,
+                                                                           coref_cache=coref_cache))
+    for doc, (instance, tokens, clusters) in nlp.pipe(preprocessed, as_tuples=True, batch_size=batch_size, n_process=n_process):
+        yield get_method_to_instance(doc, instance, tokens, clusters, methods, get_clusters, md5_ids)
+
+
+def process_instances(nlp,
+                      coref_predictor,
+                      instances: Iterable[Dict[str, Any]],
+                      method: str,
+                      batch_size: int = 32,
+                      n_process: int = 1,
+                      coref_batch_size: int = 8,
+                      coref_cache: Optional[CorefCache] = None,
+                      get_clusters: Optional[Callable[[Doc], List[List[Tuple[int, int]]]]] = None,
+                      md5_ids: bool = True) -> Iterator[Dict[str, Any]]:
+    """
+    Runs `process_instance` on a stream of instances. See `process_instances_multi`.
+    """
+    for method_to_instance in process_instances_multi(nlp, coref_predictor, instances, [method], batch_size, n_process,
+                                                      coref_batch_size, coref_cache, get_clusters, md5_ids):
+        yield method_to_instance[method]
+
+
+def load_nlp():
+    # The summaries are already tokenized by the coreference model, so spaCy should not re-tokenize them
     nlp = spacy.load('en_core_web_sm')
     nlp.tokenizer = nlp.tokenizer.tokens_from_list
+    return nlp
 
-    coref_predictor = Predictor.from_path(
-        "https://storage.googleapis.com/allennlp-public-models/coref-spanbert-large-2020.02.27.tar.gz", cuda_device=0)
 
-    with JsonlWriter(args.output_jsonl) as out:
-        for instance in tqdm(JsonlReader(args.summaries_jsonl).read()):
-            try:
-                process_instance(nlp, coref_predictor, instance, args.method)
-                out.write(instance)
-            except EmptySummaryException:
-                pass
+class StageCounter(object):
+    """
+    Counts the number of summaries a pipeline stage has processed and the time it spent on them.
+    """
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.count = 0
+        self.seconds = 0.0
+
+    def add(self, count: int, seconds: float) -> None:
+        self.count += count
+        self.seconds += seconds
+
+    def __str__(self) -> str:
+        throughput = self.count / self.seconds if self.seconds > 0 else 0.0
+        return f'{self.name}: {self.count} summaries in {self.seconds:.1f}s ({throughput:.1f} summaries/s)'
+
+
+def _candidates_worker(load_nlp_fn: Callable[[], Any],
+                       task_queue: multiprocessing.Queue,
+                       result_queue: multiprocessing.Queue,
+                       methods: List[str],
+                       get_clusters: Optional[Callable[[Doc], List[List[Tuple[int, int]]]]],
+                       md5_ids: bool) -> None:
+    # Parses batches of `(index, instance, tokens, clusters)` from `task_queue` until it gets `None`. Each
+    # batch's results are put on the `result_queue` with the time it took, then `None` when the worker is done.
+    # Exceptions are sent back as strings so the main process does not wait forever
+    try:
+        nlp = load_nlp_fn()
+        while True:
+            batch = task_queue.get()
+            if batch is None:
+                break
+            start = time.time()
+            docs = nlp.pipe([tokens for _, _, tokens, _ in batch])
+            results = []
+            for doc, (index, instance, tokens, clusters) in zip(docs, batch):
+                results.append((index, get_method_to_instance(doc, instance, tokens, clusters, methods,
+                                                              get_clusters, md5_ids)))
+            result_queue.put((results, time.time() - start))
+        result_queue.put(None)
+    except Exception:
+        result_queue.put(traceback.format_exc())
+
+
+def process_instances_parallel(load_nlp_fn: Callable[[], Any],
+                               coref_predictor,
+                               instances: Iterable[Dict[str, Any]],
+                               methods: List[str],
+                               num_workers: int,
+                               batch_size: int = 32,
+                               coref_batch_size: int = 8,
+                               coref_cache: Optional[CorefCache] = None,
+                               get_clusters: Optional[Callable[[Doc], List[List[Tuple[int, int]]]]] = None,
+                               queue_size: Optional[int] = None,
+                               md5_ids: bool = True) -> Iterator[Dict[str, Dict[str, Any]]]:
+    """
+    Runs the same steps as `process_instances_multi` as a pipeline. A reader thread runs the coreference
+    model (which stays in this process because it uses the GPU), `num_workers` processes each load spaCy
+    with `load_nlp_fn` once and extract the candidates for batches of `batch_size` summaries, and the
+    results are put back in the input order before they are yielded. Both queues hold at most `queue_size`
+    batches (default 2 * `num_workers`), so the memory does not grow if one stage is slower than the others.
+    The throughput of each stage is printed at the end.
+    """
+    queue_size = queue_size or 2 * num_workers
+    task_queue = multiprocessing.Queue(queue_size)
+    result_queue = multiprocessing.Queue(queue_size)
+    workers = [multiprocessing.Process(target=_candidates_worker,
+                                       args=(load_nlp_fn, task_queue, result_queue, methods, get_clusters, md5_ids),
+                                       daemon=True)
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    coref_counter = StageCounter('coref')
+    parse_counter = StageCounter('parse')
+    write_counter = StageCounter('write')
+    reader_errors = []
+
+    def read():
+        try:
+            batch = []
+            start = time.time()
+            preprocessed = preprocess_instances(coref_predictor, instances, coref_batch_size, coref_cache=coref_cache)
+            for index, (instance, tokens, clusters) in enumerate(preprocessed):
+                batch.append((index, instance, tokens, clusters))
+                if len(batch) == batch_size:
+                    coref_counter.add(len(batch), time.time() - start)
+                    task_queue.put(batch)
+                    batch = []
+                    start = time.time()
+            if len(batch) > 0:
+                coref_counter.add(len(batch), time.time() - start)
+                task_queue.put(batch)
+        except Exception as e:
+            reader_errors.append(e)
+        finally:
+            for _ in workers:
+                task_queue.put(None)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+
+    # The batches finish out of order, so the results are held until all of the earlier ones are written
+    next_index = 0
+    index_to_result = {}
+    num_finished = 0
+    try:
+        while num_finished < num_workers:
+            message = result_queue.get()
+            if message is None:
+                num_finished += 1
+                continue
+            if isinstance(message, str):
+                raise Exception(f'A candidate generation worker failed:\n{message}')
+
+            results, seconds = message
+            parse_counter.add(len(results), seconds)
+            index_to_result.update(results)
+            while next_index in index_to_result:
+                start = time.time()
+                yield index_to_result.pop(next_index)
+                write_counter.add(1, time.time() - start)
+                next_index += 1
+    finally:
+        if num_finished < num_workers:
+            # Nothing will read the queues anymore, so the processes would never exit on their own
+            for worker in workers:
+                worker.terminate()
+            task_queue.cancel_join_thread()
+            result_queue.cancel_join_thread()
+
+    reader.join()
+    for worker in workers:
+        worker.join()
+    if len(reader_errors) > 0:
+        raise reader_errors[0]
+    for counter in [coref_counter, parse_counter, write_counter]:
+        print(counter)
+
 
+def main(args):
+    if args.num_workers > 0 and args.n_process > 1:
+        raise Exception('--n-process cannot be used with --num-workers, where each worker parses with one process')
+
+    coref_cache = None
+    get_clusters = None
+    if args.coref == 'spanbert':
+        coref_predictor = Predictor.from_path(COREF_MODEL_ARCHIVE, cuda_device=0)
+        if args.coref_cache_dir is not None:
+            coref_cache = CorefCache(args.coref_cache_dir, COREF_MODEL_ARCHIVE)
+    else:
+        # The summaries are only tokenized and the clusters are either empty or come from the parse
+        coref_predictor = TokenizerPredictor(spacy.load('en_core_web_sm', disable=['tagger', 'parser', 'ner']).tokenizer)
+        if args.coref == 'rule':
+            get_clusters = get_rule_based_clusters
+
+    # With several methods, there is one output file per method
+    if len(args.method) == 1:
+        method_to_output_jsonl = {args.method[0]: args.output_jsonl}
+    else:
+        if '{method}' not in args.output_jsonl:
+            raise Exception('The output file must contain "{method}" if there are multiple methods')
+        method_to_output_jsonl = {method: args.output_jsonl.format(method=method) for method in args.method}
+
+    instances = JsonlReader(args.summaries_jsonl).read()
+    with ExitStack() as stack:
+        if args.resume:
+            # The output is checkpointed next to the (first) output file, and the instances which were
+            # written before the last checkpoint are skipped
+            progress_path = method_to_output_jsonl[args.method[0]] + '.progress'
+            writer = stack.enter_context(CheckpointedJsonlWriter(method_to_output_jsonl, progress_path, resume=True))
+            instances = [instance for instance in instances
+                         if (instance['instance_id'], instance['summarizer_id']) not in writer.completed_keys]
+            print(f'Skipping {len(writer.completed_keys)} completed summaries')
+
+            def write(method_to_instance: Dict[str, Dict[str, Any]]) -> None:
+                instance = next(iter(method_to_instance.values()))
+                writer.write((instance['instance_id'], instance['summarizer_id']), method_to_instance)
+        else:
+            method_to_out = {method: stack.enter_context(JsonlWriter(output_jsonl))
+                             for method, output_jsonl in method_to_output_jsonl.items()}
+
+            def write(method_to_instance: Dict[str, Dict[str, Any]]) -> None:
+                for method, instance in method_to_instance.items():
+                    method_to_out[method].write(instance)
+
+        if args.num_workers > 0:
+            processed = process_instances_parallel(load_nlp, coref_predictor, instances, args.method, args.num_workers,
+                                                   args.batch_size, args.coref_batch_size, coref_cache, get_clusters,
+                                                   args.queue_size, not args.fast_ids)
+        else:
+            processed = process_instances_multi(load_nlp(), coref_predictor, instances, args.method, args.batch_size,
+                                                args.n_process, args.coref_batch_size, coref_cache, get_clusters,
+                                                not args.fast_ids)
+        for method_to_instance in tqdm(processed, total=len(instances)):
+            write(method_to_instance)
+
+    if coref_cache is not None:
+        print(f'Coref cache: {coref_cache.hits} hits, {coref_cache.misses} misses '
+              f'({coref_cache.get_hit_rate() * 100:.1f}% hit rate)')
 
 
 if __name__ == '__main__':
     argp = argparse.ArgumentParser()
     argp.add_argument('summaries_jsonl')
     argp.add_argument('output_jsonl')
-    argp.add_argument('--method', choices=['all-nps', 'top-nps', 'ner', 'all'])
+    argp.add_argument('--method', nargs='+', choices=METHODS,
+                      help='The candidate extraction method(s). With several methods, the "{method}" in output_jsonl '
+                           'is replaced by each method\'s name')
+    argp.add_argument('--batch-size', type=int, default=32, help='The number of summaries spaCy parses at once')
+    argp.add_argument('--n-process', type=int, default=1, help='The number of processes spaCy uses to parse the summaries. Cannot be used with --num-workers')
+    argp.add_argument('--num-workers', type=int, default=0,
+                      help='If positive, the number of worker processes which parse the summaries in a pipeline with the coreference model')
+    argp.add_argument('--queue-size', type=int, help='The number of batches which can wait between the pipeline stages')
+    argp.add_argument('--fast-ids', action='store_true',
+                      help='Generate the candidate and group IDs without md5. The IDs will differ from the md5 IDs')
+    argp.add_argument('--coref', choices=['spanbert', 'none', 'rule'], default='spanbert',
+                      help='Use the SpanBERT coreference model, no coreference, or a rule-based resolver on the spaCy parse')
+    argp.add_argument('--coref-batch-size', type=int, default=8, help='The number of summaries the coreference model processes at once')
+    argp.add_argument('--coref-cache-dir', help='The directory with the cached coreference results, which is shared across runs')
+    argp.add_argument('--resume', action='store_true',
+                      help='Write the output in checkpointed chunks and skip the summaries which were written by an earlier run with --resume')
     args = argp.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
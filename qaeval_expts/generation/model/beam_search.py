@@ -1,4 +1,4 @@
-from typing import List, Callable, Tuple, Dict, cast
+from typing import List, Callable, Tuple, Dict, Union, cast
 import warnings
 
 import torch
@@ -6,7 +6,38 @@ import torch
 from allennlp.common.checks import ConfigurationError
 
 
-StateType = Dict[str, torch.Tensor]
+class BeamState:
+    """
+    A value of the beam search state which manages its own tensors instead of being expanded and
+    gathered by `BeamSearch` like a plain tensor. This lets the step function keep state which is
+    shared across the beams of an input or which can be reordered without copying all of it.
+    """
+
+    def expand(self, beam_size: int) -> None:
+        """
+        Called once after the first step to repeat every row of the state `beam_size` times, so
+        there is one row per element of the beam.
+        """
+        raise NotImplementedError
+
+    def reorder(self, backpointer: torch.Tensor) -> None:
+        """
+        Called after every following step to keep only the rows of the ancestors of the new beams.
+        `backpointer` has shape `(batch_size * beam_size,)` and contains the index of the row of
+        each new beam's ancestor in the flattened `(batch_size * beam_size)` dimension.
+        """
+        raise NotImplementedError
+
+    def select(self, indices: torch.Tensor) -> None:
+        """
+        Called when the beams of some inputs have all predicted the end token to keep only the rows
+        of the inputs which have not. `indices` has shape `(num_remaining * beam_size,)` and contains
+        the indices of the kept rows in the flattened `(batch_size * beam_size)` dimension.
+        """
+        raise NotImplementedError
+
+
+StateType = Dict[str, Union[torch.Tensor, BeamState]]
 StepFunctionType = Callable[[torch.Tensor, StateType, int], Tuple[torch.Tensor, StateType]]
 StepFunctionTypeNoTimestep = Callable[[torch.Tensor, StateType], Tuple[torch.Tensor, StateType]]
 
@@ -71,6 +102,25 @@ class BeamSearch:
 
         return reconstructed_predictions
 
+    def _select_state(self, state: StateType, indices: torch.Tensor) -> None:
+        """
+        Keeps only the rows of the state which belong to the inputs in `indices`, which has shape
+        `(num_remaining,)` and contains the indices of the inputs in the current batch.
+        """
+        # shape: (num_remaining * beam_size,)
+        flat_indices = (
+            indices.unsqueeze(1) * self.beam_size
+            + torch.arange(self.beam_size, device=indices.device).unsqueeze(0)
+        ).view(-1)
+        for key, state_tensor in state.items():
+            if state_tensor is None:
+                continue
+            if isinstance(state_tensor, BeamState):
+                state_tensor.select(flat_indices)
+                continue
+            # shape: (num_remaining * beam_size, *)
+            state[key] = state_tensor.index_select(0, flat_indices)
+
     @torch.no_grad()
     def search(
         self, start_predictions: torch.Tensor, start_state: StateType, step: StepFunctionType
@@ -98,7 +148,7 @@ class BeamSearch:
         start_state : `StateType`
             The initial state passed to the `step` function. Each value of the state dict
             should be a tensor of shape `(batch_size, *)`, where `*` means any other
-            number of dimensions.
+            number of dimensions, or a `BeamState`.
         step : `StepFunctionType`
             A function that is responsible for computing the next most likely tokens,
             given the current state and the predictions from the last time step.
@@ -106,7 +156,9 @@ class BeamSearch:
             of shape `(group_size,)`, representing the index of the predicted
             tokens from the last time step, and the second being the current state.
             The `group_size` will be `batch_size * beam_size`, except in the initial
-            step, for which it will just be `batch_size`.
+            step, for which it will just be `batch_size`. Once every beam of an input
+            has predicted the end token, the input is removed from the predictions
+            and the state, so `batch_size` only counts the inputs which have not finished.
             The function is expected to return a tuple, where the first element
             is a tensor of shape `(group_size, target_vocab_size)` containing
             the log probabilities of the tokens for the next step, and the second
@@ -196,6 +248,9 @@ class BeamSearch:
         for key, state_tensor in state.items():
             if state_tensor is None:
                 continue
+            if isinstance(state_tensor, BeamState):
+                state_tensor.expand(self.beam_size)
+                continue
             _, *last_dims = state_tensor.size()
             # shape: (batch_size * beam_size, *)
             state[key] = (
@@ -204,106 +259,155 @@ class BeamSearch:
                 .reshape(batch_size * self.beam_size, *last_dims)
             )
 
+        # The indices of the inputs which are still being decoded. Once every beam of an input has
+        # predicted the end token, it can only predict the end token from the same beams, so it is
+        # removed from the predictions and state passed to `step`, and those predictions are filled in.
+        # shape: (num_active,)
+        active_indices = torch.arange(batch_size, device=start_predictions.device)
+
+        # The predictions and backpointers of the inputs which have finished.
+        # shape: (batch_size, beam_size)
+        finished_predictions = start_predicted_classes.new_full(
+            (batch_size, self.beam_size), self._end_index
+        )
+        # shape: (batch_size, beam_size)
+        finished_backpointer = (
+            torch.arange(self.beam_size, device=start_predictions.device)
+            .unsqueeze(0)
+            .repeat(batch_size, 1)
+        )
+
         for timestep in range(self.max_steps - 1):
-            # shape: (batch_size * beam_size,)
-            last_predictions = predictions[-1].reshape(batch_size * self.beam_size)
+            # shape: (batch_size, beam_size)
+            all_last_predictions = predictions[-1]
 
             # If every predicted token from the last step is `self._end_index`,
             # then we can stop early.
-            if (last_predictions == self._end_index).all():
+            if (all_last_predictions == self._end_index).all():
                 break
 
+            # shape: (num_active,)
+            is_active = (all_last_predictions[active_indices] != self._end_index).any(dim=1)
+            if not is_active.all():
+                # shape: (num_remaining,)
+                remaining_indices = is_active.nonzero().squeeze(1)
+                active_indices = active_indices[remaining_indices]
+                self._select_state(state, remaining_indices)
+            num_active = active_indices.size(0)
+
+            # shape: (num_active * beam_size,)
+            last_predictions = all_last_predictions[active_indices].reshape(
+                num_active * self.beam_size
+            )
+
             # Take a step. This get the predicted log probs of the next classes
             # and updates the state.
-            # shape: (batch_size * beam_size, num_classes)
+            # shape: (num_active * beam_size, num_classes)
             class_log_probabilities, state = step(last_predictions, state, timestep + 1)
 
-            # shape: (batch_size * beam_size, num_classes)
+            # shape: (num_active * beam_size, num_classes)
             last_predictions_expanded = last_predictions.unsqueeze(-1).expand(
-                batch_size * self.beam_size, num_classes
+                num_active * self.beam_size, num_classes
             )
 
             # Here we are finding any beams where we predicted the end token in
             # the previous timestep and replacing the distribution with a
             # one-hot distribution, forcing the beam to predict the end token
             # this timestep as well.
-            # shape: (batch_size * beam_size, num_classes)
+            # shape: (num_active * beam_size, num_classes)
             cleaned_log_probabilities = torch.where(
                 last_predictions_expanded == self._end_index,
-                log_probs_after_end,
+                log_probs_after_end[: num_active * self.beam_size],
                 class_log_probabilities,
             )
 
-            # shape (both): (batch_size * beam_size, per_node_beam_size)
+            # shape (both): (num_active * beam_size, per_node_beam_size)
             top_log_probabilities, predicted_classes = cleaned_log_probabilities.topk(
                 self.per_node_beam_size
             )
 
-            # Here we expand the last log probabilities to (batch_size * beam_size, per_node_beam_size)
+            # Here we expand the last log probabilities to (num_active * beam_size, per_node_beam_size)
             # so that we can add them to the current log probs for this timestep.
             # This lets us maintain the log probability of each element on the beam.
-            # shape: (batch_size * beam_size, per_node_beam_size)
+            # shape: (num_active * beam_size, per_node_beam_size)
             expanded_last_log_probabilities = (
-                last_log_probabilities.unsqueeze(2)
-                .expand(batch_size, self.beam_size, self.per_node_beam_size)
-                .reshape(batch_size * self.beam_size, self.per_node_beam_size)
+                last_log_probabilities[active_indices]
+                .unsqueeze(2)
+                .expand(num_active, self.beam_size, self.per_node_beam_size)
+                .reshape(num_active * self.beam_size, self.per_node_beam_size)
             )
 
-            # shape: (batch_size * beam_size, per_node_beam_size)
+            # shape: (num_active * beam_size, per_node_beam_size)
             summed_top_log_probabilities = top_log_probabilities + expanded_last_log_probabilities
 
-            # shape: (batch_size, beam_size * per_node_beam_size)
+            # shape: (num_active, beam_size * per_node_beam_size)
             reshaped_summed = summed_top_log_probabilities.reshape(
-                batch_size, self.beam_size * self.per_node_beam_size
+                num_active, self.beam_size * self.per_node_beam_size
             )
 
-            # shape: (batch_size, beam_size * per_node_beam_size)
+            # shape: (num_active, beam_size * per_node_beam_size)
             reshaped_predicted_classes = predicted_classes.reshape(
-                batch_size, self.beam_size * self.per_node_beam_size
+                num_active, self.beam_size * self.per_node_beam_size
             )
 
             # Keep only the top `beam_size` beam indices.
-            # shape: (batch_size, beam_size), (batch_size, beam_size)
+            # shape: (num_active, beam_size), (num_active, beam_size)
             restricted_beam_log_probs, restricted_beam_indices = reshaped_summed.topk(
                 self.beam_size
             )
 
             # Use the beam indices to extract the corresponding classes.
-            # shape: (batch_size, beam_size)
+            # shape: (num_active, beam_size)
             restricted_predicted_classes = reshaped_predicted_classes.gather(
                 1, restricted_beam_indices
             )
 
-            predictions.append(restricted_predicted_classes)
+            # shape: (batch_size, beam_size)
+            predictions.append(
+                finished_predictions.index_copy(0, active_indices, restricted_predicted_classes)
+            )
 
             # shape: (batch_size, beam_size)
-            last_log_probabilities = restricted_beam_log_probs
+            last_log_probabilities = last_log_probabilities.index_copy(
+                0, active_indices, restricted_beam_log_probs
+            )
 
             # The beam indices come from a `beam_size * per_node_beam_size` dimension where the
             # indices with a common ancestor are grouped together. Hence
             # dividing by per_node_beam_size gives the ancestor. (Note that this is integer
             # division as the tensor is a LongTensor.)
-            # shape: (batch_size, beam_size)
+            # shape: (num_active, beam_size)
             backpointer = restricted_beam_indices / self.per_node_beam_size
 
-            backpointers.append(backpointer)
+            # shape: (batch_size, beam_size)
+            backpointers.append(finished_backpointer.index_copy(0, active_indices, backpointer))
+
+            # The backpointers as indices into the flattened (num_active * beam_size) dimension.
+            # shape: (num_active * beam_size,)
+            flat_backpointer = (
+                backpointer
+                + torch.arange(num_active, device=backpointer.device).unsqueeze(1) * self.beam_size
+            ).view(-1)
 
             # Keep only the pieces of the state tensors corresponding to the
             # ancestors created this iteration.
             for key, state_tensor in state.items():
                 if state_tensor is None:
                     continue
+                if isinstance(state_tensor, BeamState):
+                    state_tensor.reorder(flat_backpointer)
+                    continue
                 _, *last_dims = state_tensor.size()
-                # shape: (batch_size, beam_size, *)
+                # shape: (num_active, beam_size, *)
                 expanded_backpointer = backpointer.view(
-                    batch_size, self.beam_size, *([1] * len(last_dims))
-                ).expand(batch_size, self.beam_size, *last_dims)
+                    num_active, self.beam_size, *([1] * len(last_dims))
+                ).expand(num_active, self.beam_size, *last_dims)
 
-                # shape: (batch_size * beam_size, *)
+                # shape: (num_active * beam_size, *)
                 state[key] = (
-                    state_tensor.reshape(batch_size, self.beam_size, *last_dims)
+                    state_tensor.reshape(num_active, self.beam_size, *last_dims)
                     .gather(1, expanded_backpointer)
-                    .reshape(batch_size * self.beam_size, *last_dims)
+                    .reshape(num_active * self.beam_size, *last_dims)
                 )
 
         if not torch.isfinite(last_log_probabilities).all():
@@ -11,10 +11,79 @@ from overrides import overrides
 from transformers import BartForConditionalGeneration
 from typing import Any, Dict, List, Tuple
 
-from qaeval_expts.generation.model.beam_search import BeamSearch
+from qaeval_expts.generation.model.beam_search import BeamSearch, BeamState
 from qaeval_expts.generation.model.util import ALL_SPECIAL_TOKENS
 
 
+class EncoderState(BeamState):
+    """
+    The output of BART's encoder for the beam search. It is computed once per batch before decoding
+    and is identical for every beam of an input, so it is expanded to the beam size once and never
+    reordered by the backpointers.
+    """
+    def __init__(self, hidden_states: torch.Tensor, mask: torch.Tensor) -> None:
+        self.hidden_states = hidden_states
+        self.mask = mask
+
+    @staticmethod
+    def _expand(tensor: torch.Tensor, beam_size: int) -> torch.Tensor:
+        batch_size, *last_dims = tensor.size()
+        # shape: (batch_size * beam_size, *)
+        return (
+            tensor.unsqueeze(1)
+            .expand(batch_size, beam_size, *last_dims)
+            .reshape(batch_size * beam_size, *last_dims)
+        )
+
+    def expand(self, beam_size: int) -> None:
+        self.hidden_states = self._expand(self.hidden_states, beam_size)
+        self.mask = self._expand(self.mask, beam_size)
+
+    def reorder(self, backpointer: torch.Tensor) -> None:
+        # Every ancestor is a beam of the same input, which has the same encoder output
+        pass
+
+    def select(self, indices: torch.Tensor) -> None:
+        self.hidden_states = self.hidden_states.index_select(0, indices)
+        self.mask = self.mask.index_select(0, indices)
+
+
+class DecoderCache(BeamState):
+    """
+    BART's cache of the keys and values of the decoder's attention layers, in the format BART returns it
+    (a dict for each layer from the attention name, "self" or "encoder_decoder", to a dict of tensors).
+    The cache is reordered in place without being flattened. Only the self-attention tensors are selected
+    by the backpointers because the keys and values of the encoder-decoder attention are computed from the
+    encoder output, which is the same for every beam of an input.
+    """
+    def __init__(self) -> None:
+        # None until the first step has been run
+        self.layers = None
+
+    def expand(self, beam_size: int) -> None:
+        for layer in self.layers:
+            for attention_cache in layer.values():
+                for name, tensor in attention_cache.items():
+                    if tensor is not None:
+                        # BART views the cached tensors with the batch and head dimensions merged, so
+                        # the expanded tensors cannot share their memory between the beams
+                        attention_cache[name] = EncoderState._expand(tensor, beam_size).contiguous()
+
+    def reorder(self, backpointer: torch.Tensor) -> None:
+        for layer in self.layers:
+            attention_cache = layer['self']
+            for name, tensor in attention_cache.items():
+                if tensor is not None:
+                    attention_cache[name] = tensor.index_select(0, backpointer)
+
+    def select(self, indices: torch.Tensor) -> None:
+        for layer in self.layers:
+            for attention_cache in layer.values():
+                for name, tensor in attention_cache.items():
+                    if tensor is not None:
+                        attention_cache[name] = tensor.index_select(0, indices)
+
+
 @Model.register('question_generation')
 class QuestionGenerationModel(Model):
     def __init__(self,
@@ -81,10 +150,11 @@ class QuestionGenerationModel(Model):
                 device=source_ids.device,
             ).repeat(source_ids.shape[0], 1)
 
+            # The encoder is run once here rather than by the first decoding step
+            encoder_states = self.bart.model.encoder(input_ids=source_ids, attention_mask=source_mask)[0]
             inital_state = {
-                "input_ids": source_ids,
-                "input_mask": source_mask,
-                "encoder_states": None,
+                "encoder": EncoderState(encoder_states, source_mask),
+                "decoder_cache": DecoderCache(),
             }
             beam_result = self._beam_search.search(
                 initial_decoder_ids, inital_state, self.take_step
@@ -105,92 +175,31 @@ class QuestionGenerationModel(Model):
 
         return output_dict
 
-    @staticmethod
-    def _decoder_cache_to_dict(decoder_cache):
-        cache_dict = {}
-        for layer_index, layer_cache in enumerate(decoder_cache):
-            for attention_name, attention_cache in layer_cache.items():
-                for tensor_name, cache_value in attention_cache.items():
-                    key = (layer_index, attention_name, tensor_name)
-                    cache_dict[key] = cache_value
-        return cache_dict
-
-    @staticmethod
-    def _dict_to_decoder_cache(cache_dict):
-        decoder_cache = []
-        for key, cache_value in cache_dict.items():
-            # Split key and extract index and dict keys
-            layer_idx, attention_name, tensor_name = key
-            # Extend decoder_cache to fit layer_idx + 1 layers
-            decoder_cache = decoder_cache + [{} for _ in range(layer_idx + 1 - len(decoder_cache))]
-            cache = decoder_cache[layer_idx]
-            if attention_name not in cache:
-                cache[attention_name] = {}
-            assert tensor_name not in cache[attention_name]
-            cache[attention_name][tensor_name] = cache_value
-        return decoder_cache
-
     def take_step(
             self, last_predictions: torch.Tensor, state: Dict[str, torch.Tensor], step: int
     ) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
-        if len(last_predictions.shape) == 1:
-            last_predictions = last_predictions.unsqueeze(-1)
-
-        # Only the last predictions are needed for the decoder, but we need to pad the decoder ids
-        # to not mess up the positional embeddings in the decoder.
-        padding_size = 0
-        if step > 0:
-            padding_size = step + 1
-            padding = torch.full(
-                (last_predictions.shape[0], padding_size),
-                self._pad_id,
-                dtype=last_predictions.dtype,
-                device=last_predictions.device,
-            )
-            last_predictions = torch.cat([padding, last_predictions], dim=-1)
-
-        decoder_cache = None
-        decoder_cache_dict = {
-            k: (state[k].contiguous() if state[k] is not None else None)
-            for k in state
-            if k not in {"input_ids", "input_mask", "encoder_states"}
-        }
-        if len(decoder_cache_dict) != 0:
-            decoder_cache = self._dict_to_decoder_cache(decoder_cache_dict)
-
-        log_probabilities = None
-        for i in range(padding_size, last_predictions.shape[1]):
-            encoder_outputs = (
-                (state["encoder_states"],) if state["encoder_states"] is not None else None
-            )
-            outputs = self.bart(
-                input_ids=state["input_ids"],
-                attention_mask=state["input_mask"],
-                encoder_outputs=encoder_outputs,
-                decoder_input_ids=last_predictions[:, : i + 1],
-                decoder_cached_states=decoder_cache,
-                generation_mode=True,
-                use_cache=True,
-            )
-
-            decoder_log_probabilities = F.log_softmax(outputs[0][:, 0], dim=-1)
-
-            if log_probabilities is None:
-                log_probabilities = decoder_log_probabilities
-            else:
-                idx = last_predictions[:, i].view(-1, 1)
-                log_probabilities = decoder_log_probabilities + log_probabilities.gather(
-                    dim=-1, index=idx
-                )
-
-            decoder_cache = outputs[1][1]
-
-            state["encoder_states"] = outputs[2]
-
-        if decoder_cache is not None:
-            decoder_cache_dict = self._decoder_cache_to_dict(decoder_cache)
-            state.update(decoder_cache_dict)
+        # shape: (group_size, 1)
+        last_predictions = last_predictions.view(-1, 1)
+
+        # In generation mode, BART only embeds the last decoder input and computes its position from the
+        # number of decoder inputs. Instead of padding the inputs to that length, the last predictions are
+        # expanded to it, which does not copy them, so every step runs the decoder on one token. After the
+        # first step, the length is `step + 2` to keep the positions the model has always been decoded with
+        decoder_length = 1 if step == 0 else step + 2
+        encoder = state["encoder"]
+        decoder_cache = state["decoder_cache"]
+        outputs = self.bart(
+            input_ids=None,
+            attention_mask=encoder.mask,
+            encoder_outputs=(encoder.hidden_states,),
+            decoder_input_ids=last_predictions.expand(-1, decoder_length),
+            decoder_cached_states=decoder_cache.layers,
+            generation_mode=True,
+            use_cache=True,
+        )
+        decoder_cache.layers = outputs[1][1]
 
+        log_probabilities = F.log_softmax(outputs[0][:, 0], dim=-1)
         return log_probabilities, state
 
     @overrides
@@ -0,0 +1,36 @@
+import argparse
+import os
+from allennlp.common.util import import_module_and_submodules
+from allennlp.models.archival import load_archive
+from allennlp.predictors import Predictor
+from sacrerouge.io import JsonlReader
+
+
+def main(args):
+    import_module_and_submodules('qaeval_expts.generation.model')
+    archive = load_archive(args.model_tar_gz, cuda_device=args.cuda_device)
+    predictor = Predictor.from_archive(archive, 'question_generation')
+
+    inputs = JsonlReader(args.input_jsonl).read()
+    outputs = predictor.predict_batch_json_by_length(inputs, args.max_tokens, args.max_batch_size)
+
+    dirname = os.path.dirname(args.output_jsonl)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    with open(args.output_jsonl, 'w') as out:
+        for output in outputs:
+            out.write(predictor.dump_line(output))
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser()
+    argp.add_argument('input_jsonl')
+    argp.add_argument('model_tar_gz')
+    argp.add_argument('output_jsonl')
+    argp.add_argument('--max-tokens', type=int, default=1024,
+                      help='The maximum number of source tokens in a batch, including the padding')
+    argp.add_argument('--max-batch-size', type=int, default=64)
+    argp.add_argument('--cuda-device', type=int, default=-1)
+    args = argp.parse_args()
+    main(args)
@@ -3,6 +3,31 @@ from allennlp.common.util import JsonDict
 from allennlp.data import Instance
 from allennlp.predictors import Predictor
 from overrides import overrides
+from typing import List
+
+
+def get_length_batches(lengths: List[int], max_tokens: int, max_batch_size: int) -> List[List[int]]:
+    """
+    Groups the indices of the inputs with the given lengths into batches of inputs with similar lengths.
+    The inputs are sorted from longest to shortest, and a batch is full when adding the next input would
+    make its padded size (the number of inputs times the length of the longest one) larger than
+    `max_tokens` or its number of inputs larger than `max_batch_size`. An input which is longer than
+    `max_tokens` is put in a batch by itself.
+    """
+    # The sort is stable, so inputs with the same length stay in their original order
+    order = sorted(range(len(lengths)), key=lambda index: -lengths[index])
+    batches = []
+    batch = []
+    for index in order:
+        # The first input of a batch is its longest one
+        padded_size = (len(batch) + 1) * lengths[batch[0]] if len(batch) > 0 else 0
+        if len(batch) > 0 and (padded_size > max_tokens or len(batch) == max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
 
 
 @Predictor.register('question_generation')
@@ -24,6 +49,24 @@ class QuestionGenerationPredictor(Predictor):
                                                      end=answer_end,
                                                      metadata=metadata)
 
+    def predict_batch_json_by_length(self,
+                                     inputs: List[JsonDict],
+                                     max_tokens: int,
+                                     max_batch_size: int) -> List[JsonDict]:
+        """
+        Predicts the questions for the inputs in batches of inputs with similar tokenized lengths (see
+        `get_length_batches`) instead of in their original order, which reduces the padding in the encoder
+        and decoder. The outputs are returned in the same order as the inputs.
+        """
+        instances = [self._json_to_instance(json_dict) for json_dict in inputs]
+        lengths = [len(instance['source_tokens']) for instance in instances]
+        outputs = [None] * len(instances)
+        for batch in get_length_batches(lengths, max_tokens, max_batch_size):
+            batch_outputs = self.predict_batch_instance([instances[index] for index in batch])
+            for index, output in zip(batch, batch_outputs):
+                outputs[index] = output
+        return outputs
+
     @overrides
     def dump_line(self, outputs: JsonDict) -> str:
         input_dict = outputs['metadata']['input_dict']
@@ -1,5 +1,9 @@
-import itertools
-from collections import defaultdict, namedtuple
+import logging
+import numpy as np
+import os
+import re
+from collections import Counter
+from collections.abc import Sequence
 from sacrerouge.data import EvalInstance, MetricsDict
 from sacrerouge.data.dataset_readers import DatasetReader
 from sacrerouge.data.jackknifers import Jackknifer
@@ -7,34 +11,65 @@ from sacrerouge.data.fields import Fields, Field, SummaryField
 from sacrerouge.data.types import SummaryType
 from sacrerouge.io import JsonlReader
 from sacrerouge.metrics import Metric, PythonRouge
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-AnsweredQuestion = namedtuple('AnsweredQuestion',
-                              ['prompt_id', 'question_id', 'prediction_id', 'question', 'answer',
-                               'prediction', 'probability', 'null_probability', 'group_id', 'is_correct'])
+from qaeval_expts.answered_questions import AnsweredQuestion, AnsweredQuestionStore, get_content_digest, \
+    get_prediction_ids, index_answered_questions
+from qaeval_expts.answers_columns import AnswersColumnsReader, is_answers_columns
+from qaeval_expts.cache import LRUCache
+from qaeval_expts.columnar import AnsweredQuestionsTable, METRIC_NAMES, grouped_mean
+
+logger = logging.getLogger(__name__)
+
+
+class AnsweredQuestionsFold(Sequence):
+    """
+    A jackknifing fold of an answered questions list: every reference except the one at `held_out`.
+    The fold is a view of the original list, so creating one does not copy anything, and the
+    metric can score the original references once and derive the fold's score from them.
+    """
+    def __init__(self, answered_questions_list: List[List[AnsweredQuestion]], held_out: int) -> None:
+        self.answered_questions_list = answered_questions_list
+        self.held_out = held_out
+
+    def __len__(self) -> int:
+        return len(self.answered_questions_list) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        if index >= self.held_out:
+            index += 1
+        return self.answered_questions_list[index]
 
 
 class AnsweredQuestionsField(Field):
     def __init__(self, answered_questions_list: List[List[AnsweredQuestion]]):
         self.answered_questions_list = answered_questions_list
+        self._hash = None
 
     def __hash__(self) -> int:
-        hashes = []
-        for answered_questions in self.answered_questions_list:
-            for answered_question in answered_questions:
+        # The field is hashed every time it is used as a dictionary key, so the hash is only computed once
+        if self._hash is None:
+            hashes = []
+            for answered_questions in self.answered_questions_list:
                 # The prediction_id is unique
-                hashes.append(hash(answered_question.prediction_id))
-        return hash(tuple(hashes))
+                hashes.extend(map(hash, get_prediction_ids(answered_questions)))
+            self._hash = hash(tuple(hashes))
+        return self._hash
 
     def __eq__(self, other: 'Field') -> bool:
+        if self is other:
+            return True
         if len(self.answered_questions_list) != len(other.answered_questions_list):
             return False
         for answered_questions, other_answered_questions in zip(self.answered_questions_list, other.answered_questions_list):
-            if len(answered_questions) != len(other_answered_questions):
+            if get_prediction_ids(answered_questions) != get_prediction_ids(other_answered_questions):
                 return False
-            for aq1, aq2 in zip(answered_questions, other_answered_questions):
-                if aq1.prediction_id != aq2.prediction_id:
-                    return False
         return True
 
     def to_input(self) -> Any:
@@ -44,48 +79,87 @@ class AnsweredQuestionsField(Field):
 
 @DatasetReader.register('qa-scoring')
 class QAScoringDatasetReader(DatasetReader):
-    def read(self, input_jsonl: str) -> List[EvalInstance]:
-        eval_instances = []
-        with JsonlReader(input_jsonl) as f:
-            for instance in f:
-                instance_id = instance['instance_id']
-                summarizer_id = instance['summarizer_id']
-                summarizer_type = instance['summarizer_type']
-                summary = SummaryField(instance['summary']['text'])
-
-                answered_questions_list = []
-                for reference in instance['references']:
-                    this_question_list = []
-                    for question_dict in reference['questions']:
-                        prompt_id = question_dict['prompt_id']
-                        question_id = question_dict['question_id']
-                        group_id = question_dict['group_id'] if 'group_id' in question_dict else None
-                        question = question_dict['question']
-                        answer = question_dict['answer']
-                        for prediction_dict in question_dict['predictions']:
-                            prediction_id = prediction_dict['prediction_id']
-                            prediction = prediction_dict['answer']
-                            probability = prediction_dict['probability']
-                            null_probability = prediction_dict['null_probability']
-
-                            if 'is_correct' in prediction_dict:
-                                is_correct = prediction_dict['is_correct']
-                            else:
-                                # Dummy
-                                is_correct = False
-
-                            this_question_list.append(AnsweredQuestion(prompt_id, question_id, prediction_id, question, answer, prediction, probability, null_probability, group_id, is_correct))
-
-                    if len(this_question_list) > 0:
-                        answered_questions_list.append(this_question_list)
+    def __init__(self, compact: bool = False) -> None:
+        # If true, each reference's answered questions are stored in an `AnsweredQuestionStore`
+        # instead of a list of `AnsweredQuestion`s, which uses much less memory for large files
+        super().__init__()
+        self.compact = compact
 
+    def read(self, input_jsonl: str) -> List[EvalInstance]:
+        return list(self.iter_instances(input_jsonl))
+
+    def iter_instances(self,
+                       input_jsonl: str,
+                       include_instance: Optional[Callable[[str], bool]] = None) -> Iterator[EvalInstance]:
+        """
+        Lazily parses the instances one line at a time so the whole file is never in memory. The input
+        can also be a directory written by `AnswersColumnsWriter`, which is always read into compact stores.
+        If `include_instance` is given, only the instances whose `instance_id` it returns true for are
+        parsed.
+        """
+        if is_answers_columns(input_jsonl):
+            reader = AnswersColumnsReader(input_jsonl)
+            for instance_id, summarizer_id, summarizer_type, summary, references in reader.iter_instances(include_instance):
+                answered_questions_list = [index_answered_questions(reference) for reference in references if len(reference) > 0]
                 if len(answered_questions_list) > 0:
                     fields = Fields({
-                        'summary': summary,
+                        'summary': SummaryField(summary),
                         'answered_questions': AnsweredQuestionsField(answered_questions_list)
                     })
-                    eval_instances.append(EvalInstance(instance_id, summarizer_id, summarizer_type, fields))
-        return eval_instances
+                    yield EvalInstance(instance_id, summarizer_id, summarizer_type, fields)
+            return
+
+        with JsonlReader(input_jsonl) as f:
+            for instance in f:
+                if include_instance is not None and not include_instance(instance['instance_id']):
+                    continue
+                eval_instance = self.parse_instance(instance)
+                if eval_instance is not None:
+                    yield eval_instance
+
+    def parse_instance(self, instance: Dict[str, Any]) -> Optional[EvalInstance]:
+        instance_id = instance['instance_id']
+        summarizer_id = instance['summarizer_id']
+        summarizer_type = instance['summarizer_type']
+        summary = SummaryField(instance['summary']['text'])
+
+        answered_questions_list = []
+        for reference in instance['references']:
+            this_question_list = []
+            for question_dict in reference['questions']:
+                prompt_id = question_dict['prompt_id']
+                question_id = question_dict['question_id']
+                group_id = question_dict['group_id'] if 'group_id' in question_dict else None
+                question = question_dict['question']
+                answer = question_dict['answer']
+                for prediction_dict in question_dict['predictions']:
+                    prediction_id = prediction_dict['prediction_id']
+                    prediction = prediction_dict['answer']
+                    probability = prediction_dict['probability']
+                    null_probability = prediction_dict['null_probability']
+
+                    if 'is_correct' in prediction_dict:
+                        is_correct = prediction_dict['is_correct']
+                    else:
+                        # Dummy
+                        is_correct = False
+
+                    this_question_list.append(AnsweredQuestion(prompt_id, question_id, prediction_id, question, answer, prediction, probability, null_probability, group_id, is_correct))
+
+            if len(this_question_list) > 0:
+                if self.compact:
+                    this_question_list = AnsweredQuestionStore.from_list(this_question_list)
+                # Sort and group the answered questions once here instead of every time they are scored
+                answered_questions_list.append(index_answered_questions(this_question_list))
+
+        if len(answered_questions_list) == 0:
+            return None
+
+        fields = Fields({
+            'summary': summary,
+            'answered_questions': AnsweredQuestionsField(answered_questions_list)
+        })
+        return EvalInstance(instance_id, summarizer_id, summarizer_type, fields)
 
 
 class AnsweredQuestionsJackknifer(Jackknifer):
@@ -99,109 +173,211 @@ class AnsweredQuestionsJackknifer(Jackknifer):
         for i in range(len(field.answered_questions_list)):
             jk_fields = Fields(fields)
             jk_fields['answered_questions'] = AnsweredQuestionsField(
-                field.answered_questions_list[:i] + field.answered_questions_list[i + 1:])
+                AnsweredQuestionsFold(field.answered_questions_list, i))
             jk_fields_list.append(jk_fields)
         return jk_fields_list
 
 
 @Metric.register('qa-scoring')
 class QAScoringMetric(Metric):
-    def __init__(self) -> None:
+    _non_alphanumeric_regex = re.compile('[^A-Za-z0-9]')
+
+    # The scores of the most recently scored inputs, shared by all of the metric objects in the
+    # process. The scores only depend on the answered questions and the metric's options, so the keys
+    # are the content digests of the references plus the options (see `_get_result_cache_key`). The
+    # prediction IDs are not enough because they do not change if the same questions are answered
+    # by a different model or judged differently. The cache is only used with `use_result_cache`,
+    # which is off by default: `sacrerouge score` calls `score_multi_all` once, where the repeated inputs
+    # and jackknifing folds are already deduplicated, so hashing every reference would be pure overhead.
+    # It is meant for callers which score the same answered questions in several calls
+    result_cache = LRUCache(10000)
+
+    def __init__(self,
+                 f1_cache_size: Optional[int] = 1000000,
+                 f1_cache_file: Optional[str] = None,
+                 use_result_cache: bool = False,
+                 incremental_jackknifing: bool = True,
+                 group_averaging: bool = False) -> None:
         super().__init__(['summary'], ['answered_questions'], jackknifer=AnsweredQuestionsJackknifer())
         self.rouge = PythonRouge(ngram_orders=[1], remove_stopwords=True, use_porter_stemmer=True)
 
-    def _calculate_exact_match(self,
-                               answer: str,
-                               prediction: str,
-                               probability: float,
-                               null_probability: float) -> Dict[str, float]:
-        if prediction is None:
-            em_null = 0.0
-        else:
-            em = int(prediction == answer)
-            em_null = 0
-            if probability > null_probability:
-                em_null = em
-
-        return {
-            'exact-match': em_null,
-        }
-
-    def _calculate_f1(self,
-                      answer: str,
-                      prediction: str,
-                      probability: float,
-                      null_probability: float) -> Dict[str, float]:
-        if prediction is None:
-            f1_null = 0.0
-        else:
-            f1 = self.rouge.score(prediction, [answer])['python-rouge-1']['f1']
-            f1_null = 0
-            if probability > null_probability:
-                f1_null = f1
-
-        return {
-            'f1': f1_null,
-        }
-
-    def _calculate_is_answerable(self, probability: float, null_probability: float) -> Dict[str, float]:
-        return {'is-answerable': int(probability > null_probability)}
-
-    def _calculate_human_is_correct(self, is_correct: bool):
-        return {'human-is-correct': int(is_correct)}
-
-    def _score_question(self, answered_questions: List[AnsweredQuestion]) -> MetricsDict:
-        # Average over answers
-        metrics = []
-        for aq in answered_questions:
-            em = self._calculate_exact_match(aq.answer, aq.prediction, aq.probability, aq.null_probability)
-            f1 = self._calculate_f1(aq.answer, aq.prediction, aq.probability, aq.null_probability)
-            is_answerable = self._calculate_is_answerable(aq.probability, aq.null_probability)
-            human_is_correct = self._calculate_human_is_correct(aq.is_correct)
-            metrics.append(MetricsDict(dict(**em, **f1, **is_answerable, **human_is_correct)))
-        return sum(metrics) / len(metrics)
-
-    def _score_prompt(self, answered_questions: List[AnsweredQuestion]) -> MetricsDict:
-        # Average over questions
-        metrics = []
-        for _, aqs in itertools.groupby(answered_questions, key=lambda aq: aq.question_id):
-            metrics.append(self._score_question(list(aqs)))
-        return sum(metrics) / len(metrics)
-
-    def _score_reference(self, answered_questions: List[AnsweredQuestion]) -> MetricsDict:
-        # Sort over the prompts then questions in one shot to setup the groupbys
-        answered_questions.sort(key=lambda aq: (aq.prompt_id, aq.question_id))
-
-        # Average over prompts
-        metrics = []
-        group_to_metrics = defaultdict(list)
-        for _, aqs in itertools.groupby(answered_questions, key=lambda aq: aq.prompt_id):
-            aqs = list(aqs)
-            prompt_metrics = self._score_prompt(aqs)
-            metrics.append(prompt_metrics)
-
-            # All questions of the same prompt should be in the same group, so we can just take
-            # the first one
-            if aqs[0].group_id is not None:
-                group_to_metrics[aqs[0].group_id].append(prompt_metrics)
-
-        metrics = sum(metrics) / len(metrics)
+        # The same (answer, prediction) pairs are scored for many summaries and jackknifing folds, so
+        # the F1 scores and the stemmed unigram counts of each string are cached. The F1 cache
+        # can optionally be saved to `f1_cache_file` to be reused across runs
+        self.f1_cache = LRUCache(f1_cache_size)
+        self.token_counts_cache = LRUCache(f1_cache_size)
+        self.f1_cache_file = f1_cache_file
+        if f1_cache_file is not None and os.path.exists(f1_cache_file):
+            self.f1_cache.load(f1_cache_file)
+            logger.info(f'Loaded {len(self.f1_cache)} F1 scores from {f1_cache_file}')
+
+        self.use_result_cache = use_result_cache
+
+        # If true, the score for a jackknifing fold is computed by subtracting the held out reference's
+        # score from the sum over all of the references. This can differ from scoring the fold directly
+        # by floating point rounding error
+        self.incremental_jackknifing = incremental_jackknifing
+
+        # If true, the metrics are also reported as "qa-eval-group", which averages the prompts within each
+        # group (the sentence the prompt came from) and then over the groups, so every sentence of the reference
+        # is weighted equally instead of every prompt
+        self.group_averaging = group_averaging
+
+    def _calculate_exact_match(self, answer: str, prediction: str) -> float:
+        return float(prediction == answer)
+
+    def _normalize(self, text: str) -> str:
+        # The same normalization that ROUGE applies before stopword removal and stemming
+        return ' '.join(QAScoringMetric._non_alphanumeric_regex.sub(' ', text).lower().split())
+
+    def _get_token_counts(self, text: str) -> Counter:
+        counts = self.token_counts_cache.get(text)
+        if counts is None:
+            counts = self.rouge._count_ngrams(self.rouge.preprocess_summary(text), 1)
+            self.token_counts_cache[text] = counts
+        return counts
+
+    def _calculate_f1(self, answer: str, prediction: str) -> float:
+        # Equivalent to self.rouge.score(prediction, [answer])['python-rouge-1']['f1']
+        key = (self._normalize(answer), self._normalize(prediction))
+        f1 = self.f1_cache.get(key)
+        if f1 is None:
+            answer_counts = self._get_token_counts(key[0])
+            prediction_counts = self._get_token_counts(key[1])
+            answer_total, prediction_total, intersection = \
+                self.rouge._calculate_intersection(answer_counts, prediction_counts)
+            _, _, f1 = self.rouge._calculate_pr_f1(answer_total, prediction_total, intersection)
+            self.f1_cache[key] = f1
+        return f1
+
+    def _log_cache_statistics(self) -> None:
+        logger.info(f'F1 cache: {self.f1_cache.hits} hits, {self.f1_cache.misses} misses '
+                    f'({self.f1_cache.get_hit_rate() * 100:.1f}% hit rate)')
+        logger.info(f'Token counts cache: {self.token_counts_cache.hits} hits, {self.token_counts_cache.misses} misses '
+                    f'({self.token_counts_cache.get_hit_rate() * 100:.1f}% hit rate)')
+        if self.use_result_cache:
+            logger.info(f'Result cache: {self.result_cache.hits} hits, {self.result_cache.misses} misses '
+                        f'({self.result_cache.get_hit_rate() * 100:.1f}% hit rate)')
+
+    def _score_rows(self, table: AnsweredQuestionsTable) -> np.ndarray:
+        # The EM and F1 are only counted if the model thinks the question is answerable, so
+        # the (expensive) comparisons to the answer are skipped for the rest of the rows
+        is_answerable = table.probability > table.null_probability
+        has_prediction = np.array([prediction is not None for prediction in table.predictions], dtype=bool)
+
+        values = np.zeros((len(table), len(METRIC_NAMES)))
+        for i in np.flatnonzero(is_answerable & has_prediction):
+            answer, prediction = table.answers[i], table.predictions[i]
+            values[i, 0] = self._calculate_exact_match(answer, prediction)
+            values[i, 1] = self._calculate_f1(answer, prediction)
+        values[:, 2] = is_answerable
+        values[:, 3] = table.is_correct
+        return values
+
+    def _to_metrics_dict(self, values: np.ndarray) -> MetricsDict:
+        metrics = MetricsDict({'qa-eval': {name: float(value) for name, value in zip(METRIC_NAMES, values)}})
+        if self.group_averaging:
+            group_values = values[len(METRIC_NAMES):]
+            metrics['qa-eval-group'] = {name: float(value) for name, value in zip(METRIC_NAMES, group_values)}
         return metrics
 
-    def _score(self, answered_questions_list: List[List[AnsweredQuestion]]) -> MetricsDict:
+    def _score_all(self, answered_questions_lists: List[List[List[AnsweredQuestion]]]) -> np.ndarray:
+        # The jackknifing folds share their references with the full answered questions list, so
+        # every distinct reference is only scored once, in one pass over all of the inputs
+        references = []
+        reference_to_index = {}
+        for answered_questions_list in answered_questions_lists:
+            if isinstance(answered_questions_list, AnsweredQuestionsFold):
+                answered_questions_list = answered_questions_list.answered_questions_list
+            for answered_questions in answered_questions_list:
+                if id(answered_questions) not in reference_to_index:
+                    reference_to_index[id(answered_questions)] = len(references)
+                    references.append(answered_questions)
+
+        table = AnsweredQuestionsTable(references)
+        reference_metrics = table.reference_means(self._score_rows(table), include_groups=self.group_averaging)
+
         # Average over references
-        metrics = []
-        for answered_questions in answered_questions_list:
-            metrics.append(self._score_reference(answered_questions))
-        final_metrics = sum(metrics) / len(metrics)
-        return MetricsDict({'qa-eval': final_metrics})
+        input_indices = []
+        input_ids = []
+        reference_indices = []
+        fold_indices = []
+        for i, answered_questions_list in enumerate(answered_questions_lists):
+            if self.incremental_jackknifing and isinstance(answered_questions_list, AnsweredQuestionsFold):
+                fold_indices.append(i)
+                continue
+            for answered_questions in answered_questions_list:
+                input_ids.append(len(input_indices))
+                reference_indices.append(reference_to_index[id(answered_questions)])
+            input_indices.append(i)
+
+        input_metrics = np.empty((len(answered_questions_lists), reference_metrics.shape[1]))
+        input_metrics[input_indices] = grouped_mean(reference_metrics[reference_indices],
+                                                    np.array(input_ids, dtype=int),
+                                                    len(input_indices))
+
+        # The folds are derived from the sum over all of their original list's references
+        reference_sums = {}
+        for i in fold_indices:
+            fold = answered_questions_lists[i]
+            key = id(fold.answered_questions_list)
+            indices = [reference_to_index[id(answered_questions)] for answered_questions in fold.answered_questions_list]
+            if key not in reference_sums:
+                reference_sums[key] = reference_metrics[indices].sum(axis=0)
+            held_out_metrics = reference_metrics[indices[fold.held_out]]
+            input_metrics[i] = (reference_sums[key] - held_out_metrics) / len(fold)
+        return input_metrics
+
+    def _score(self, answered_questions_list: List[List[AnsweredQuestion]]) -> MetricsDict:
+        return self._to_metrics_dict(self._score_all([answered_questions_list])[0])
+
+    def _get_result_cache_key(self,
+                              field: AnsweredQuestionsField,
+                              reference_digests: Dict[int, str]) -> Tuple[bool, bool, Tuple[str, ...]]:
+        # `reference_digests` maps from the `id` of the references to their digests, so the references which
+        # are shared by the jackknifing folds are only hashed once per call
+        digests = []
+        for answered_questions in field.answered_questions_list:
+            if id(answered_questions) not in reference_digests:
+                reference_digests[id(answered_questions)] = get_content_digest(answered_questions)
+            digests.append(reference_digests[id(answered_questions)])
+        return self.group_averaging, self.incremental_jackknifing, tuple(digests)
 
     def score_multi_all(self,
                         summaries_list: List[List[SummaryType]],
                         answered_questions_lists: List[List[List[AnsweredQuestion]]]) -> List[List[MetricsDict]]:
+        # The scores do not depend on the summary, so each distinct set of answered questions is
+        # only scored once, either here or by an earlier call which put it in the result cache
+        fields = [AnsweredQuestionsField(answered_questions_list) for answered_questions_list in answered_questions_lists]
+        field_to_metrics = {}
+        field_to_cache_key = {}
+        reference_digests = {}
+        fields_to_score = []
+        for field in fields:
+            if field in field_to_metrics:
+                continue
+            values = None
+            if self.use_result_cache:
+                field_to_cache_key[field] = self._get_result_cache_key(field, reference_digests)
+                values = self.result_cache.get(field_to_cache_key[field])
+            field_to_metrics[field] = values
+            if values is None:
+                fields_to_score.append(field)
+
+        if len(fields_to_score) > 0:
+            input_metrics = self._score_all([field.answered_questions_list for field in fields_to_score])
+            for field, values in zip(fields_to_score, input_metrics):
+                field_to_metrics[field] = values
+                if self.use_result_cache:
+                    self.result_cache[field_to_cache_key[field]] = values
+
         metrics_list = []
-        for summaries, answered_questions_list in zip(summaries_list, answered_questions_lists):
+        for summaries, field in zip(summaries_list, fields):
             metrics_list.append([])
             for _ in summaries:
-                metrics_list[-1].append(self._score(answered_questions_list))
+                metrics_list[-1].append(self._to_metrics_dict(field_to_metrics[field]))
+
+        self._log_cache_statistics()
+        if self.f1_cache_file is not None:
+            self.f1_cache.save(self.f1_cache_file)
         return metrics_list
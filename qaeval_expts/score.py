@@ -0,0 +1,172 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from collections import defaultdict, deque
+from multiprocessing import Pool
+from sacrerouge.commands.score import score_instances
+from sacrerouge.data import Metrics
+from sacrerouge.io import JsonlWriter
+from tqdm import tqdm
+from typing import Any, Iterator, List, Optional, Tuple
+
+from qaeval_expts.answers_columns import AnswersColumnsReader, is_answers_columns
+from qaeval_expts.cache import LRUCache
+from qaeval_expts.metric import QAScoringDatasetReader, QAScoringMetric
+
+
+def get_shard(instance_id: str, num_shards: int) -> int:
+    # Python's `hash` is randomized per process, so md5 is used to make the sharding deterministic
+    return int(hashlib.md5(instance_id.encode()).hexdigest(), 16) % num_shards
+
+
+def load_metric(disable_incremental_jackknifing: bool,
+                f1_cache_file: Optional[str],
+                group_averaging: bool = False) -> QAScoringMetric:
+    # Every instance is scored separately and the answered questions of different instances are never the
+    # same, so the result cache stays disabled
+    metric = QAScoringMetric(incremental_jackknifing=not disable_incremental_jackknifing,
+                             group_averaging=group_averaging)
+    if f1_cache_file is not None and os.path.exists(f1_cache_file):
+        metric.f1_cache.load(f1_cache_file)
+    return metric
+
+
+def score_stream(metric: QAScoringMetric,
+                 input_path: str,
+                 disable_peer_jackknifing: bool,
+                 shard: int = 0,
+                 num_shards: int = 1) -> Iterator[Metrics]:
+    # Each instance's QAEval score (including jackknifing) only depends on its own answered questions,
+    # so the instances can be scored one at a time without holding the whole file in memory. The other
+    # shards' instances are skipped before their answered questions are read
+    def include_instance(instance_id: str) -> bool:
+        return get_shard(instance_id, num_shards) == shard
+
+    dataset_reader = QAScoringDatasetReader()
+    for instance in dataset_reader.iter_instances(input_path, include_instance if num_shards > 1 else None):
+        metrics_dicts = score_instances([instance], [metric], disable_peer_jackknifing)
+        yield metrics_dicts[instance.instance_id][instance.summarizer_id]
+
+
+def split_jsonl(input_jsonl: str, output_dir: str, num_shards: int) -> Tuple[List[str], List[Tuple[str, str]]]:
+    # The lines are copied without being deserialized into instances, so this is much cheaper than scoring.
+    # The `(instance_id, summarizer_id)` of every line is returned in the input order
+    keys = []
+    shard_paths = [os.path.join(output_dir, f'{shard}.jsonl') for shard in range(num_shards)]
+    shard_files = [open(path, 'w') for path in shard_paths]
+    open_fn = gzip.open if input_jsonl.endswith('.gz') else open
+    with open_fn(input_jsonl, 'rt') as f:
+        for line in f:
+            if line.strip():
+                instance = json.loads(line)
+                instance_id = instance['instance_id']
+                keys.append((instance_id, instance['summarizer_id']))
+                shard_files[get_shard(instance_id, num_shards)].write(line.rstrip('\n') + '\n')
+    for shard_file in shard_files:
+        shard_file.close()
+    return shard_paths, keys
+
+
+# The metric of each worker process, which is created by `_init_worker` so the F1 cache file is only
+# loaded once per worker instead of once per shard
+_worker_metric = None
+_worker_f1_cache_keys = None
+
+
+def _init_worker(disable_incremental_jackknifing: bool, f1_cache_file: Optional[str], group_averaging: bool) -> None:
+    global _worker_metric, _worker_f1_cache_keys
+    _worker_metric = load_metric(disable_incremental_jackknifing, f1_cache_file, group_averaging)
+    _worker_f1_cache_keys = set(key for key, _ in _worker_metric.f1_cache.items()) if f1_cache_file is not None else None
+
+
+def _score_shard(shard_args: Tuple[Any, ...]) -> Tuple[List[Metrics], Optional[List[Tuple[Any, float]]]]:
+    input_path, shard, num_shards, disable_peer_jackknifing = shard_args
+    metrics_list = list(score_stream(_worker_metric, input_path, disable_peer_jackknifing, shard, num_shards))
+
+    # Only the F1 scores which this worker has not already loaded or sent are sent back, so the parent
+    # process can update the cache file without the workers overwriting each other
+    f1_cache_items = None
+    if _worker_f1_cache_keys is not None:
+        f1_cache_items = [(key, value) for key, value in _worker_metric.f1_cache.items() if key not in _worker_f1_cache_keys]
+        _worker_f1_cache_keys.update(key for key, _ in f1_cache_items)
+    return metrics_list, f1_cache_items
+
+
+def score_parallel(args) -> None:
+    # The instances are sharded by `instance_id` and each shard is scored by a separate process. The
+    # results are put back in the input order before they are written, so the output is the same as
+    # `score_stream`'s and does not depend on the number of processes or the order in which the shards finish
+    num_shards = args.num_shards or args.num_processes * 4
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if is_answers_columns(args.answers_jsonl):
+            # The columnar answers are memory-mapped, so every worker opens the full input and skips
+            # the other shards' instances without decoding them
+            shard_args = [(args.answers_jsonl, shard, num_shards) for shard in range(num_shards)]
+            keys = AnswersColumnsReader(args.answers_jsonl).iter_keys()
+        else:
+            shard_paths, keys = split_jsonl(args.answers_jsonl, temp_dir, num_shards)
+            shard_args = [(shard_path, 0, 1) for shard_path in shard_paths]
+        shard_args = [shard_arg + (args.disable_peer_jackknifing,) for shard_arg in shard_args]
+
+        metrics_list = []
+        f1_cache = LRUCache()
+        if args.f1_cache_file is not None and os.path.exists(args.f1_cache_file):
+            f1_cache.load(args.f1_cache_file)
+        init_args = (args.disable_incremental_jackknifing, args.f1_cache_file, args.group_averaging)
+        with Pool(args.num_processes, initializer=_init_worker, initargs=init_args) as pool:
+            for shard_metrics_list, f1_cache_items in tqdm(pool.imap_unordered(_score_shard, shard_args), total=num_shards):
+                metrics_list.extend(shard_metrics_list)
+                for key, value in f1_cache_items or []:
+                    f1_cache[key] = value
+
+    # If the same IDs are repeated, their instances are in the same shard, which scores them in the input
+    # order, so they are assigned their input positions in that order
+    key_to_positions = defaultdict(deque)
+    for position, key in enumerate(keys):
+        key_to_positions[key].append(position)
+    positions = [key_to_positions[(metrics.instance_id, metrics.summarizer_id)].popleft() for metrics in metrics_list]
+    with JsonlWriter(args.output_jsonl) as out:
+        for _, metrics in sorted(zip(positions, metrics_list), key=lambda pair: pair[0]):
+            out.write(metrics)
+
+    if args.f1_cache_file is not None:
+        f1_cache.save(args.f1_cache_file)
+
+
+def main(args):
+    # This is the equivalent of `sacrerouge score --config data/metric.jsonnet`, but it either streams the
+    # instances so that the memory usage does not grow with the size of the answers file or scores
+    # shards of the input in parallel with `--num-processes`. In both cases, the metrics are written in
+    # the same order as the input file instead of sorted by the IDs.
+    dirname = os.path.dirname(args.output_jsonl)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    if args.num_processes > 1:
+        score_parallel(args)
+        return
+
+    metric = load_metric(args.disable_incremental_jackknifing, args.f1_cache_file, args.group_averaging)
+    with JsonlWriter(args.output_jsonl) as out:
+        for metrics in tqdm(score_stream(metric, args.answers_jsonl, args.disable_peer_jackknifing)):
+            out.write(metrics)
+
+    if args.f1_cache_file is not None:
+        metric.f1_cache.save(args.f1_cache_file)
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser()
+    argp.add_argument('answers_jsonl')
+    argp.add_argument('output_jsonl')
+    argp.add_argument('--disable-peer-jackknifing', action='store_true')
+    argp.add_argument('--disable-incremental-jackknifing', action='store_true')
+    argp.add_argument('--f1-cache-file')
+    argp.add_argument('--group-averaging', action='store_true', help='Also report the "qa-eval-group" metrics')
+    argp.add_argument('--num-processes', type=int, default=1)
+    argp.add_argument('--num-shards', type=int, help='The number of shards to split the input into (default 4 * num-processes)')
+    args = argp.parse_args()
+    main(args)